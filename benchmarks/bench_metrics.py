@@ -0,0 +1,288 @@
+"""Benchmark the locality splitting metrics on synthetic states.
+
+Run from the main folder of the repository, e.g.
+
+    python benchmarks/bench_metrics.py --output new.json --compare old.json
+
+Every benchmark runs on synthetic block tables shaped like real states (number of
+blocks, counties and districts), so no data or network access is needed. Results
+are printed and optionally saved as JSON, which can be compared against the
+results of another commit.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import metrics  # noqa: E402
+
+
+# (blocks, counties, districts) of 2010 census blocks and one of the state's plans
+STATES = {'DE': (24115, 3, 41),
+          'NH': (48837, 10, 2),
+          'CT': (67578, 8, 36),
+          'NY': (350169, 62, 150),
+          'PA': (421545, 67, 18),
+          'CA': (710145, 58, 80),
+          'TX': (914231, 254, 150)}
+
+# every block and county in the country, with congressional districts
+NATION = (11078297, 3143, 435)
+
+# metric functions that can be scored on their own
+METRIC_FUNCTIONS = [(metrics.localities_split, None),
+                    (metrics.locality_intersections, None),
+                    (metrics.effective_splits, None),
+                    (metrics.conditional_entropy, 1),
+                    (metrics.sqrt_entropy, 1),
+                    (metrics.split_pairs, 1)]
+
+
+def main():
+    """Run the benchmarks, print the results, and save and compare them if asked."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--states', default=','.join(STATES),
+                        help='comma-separated synthetic states to run (default: all)')
+    parser.add_argument('--plans', type=int, default=20,
+                        help='number of plans in each ensemble benchmark')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of timed runs of each benchmark')
+    parser.add_argument('--national', action='store_true',
+                        help='extend the scaling curve to a national-size table')
+    parser.add_argument('--output', help='path of JSON file to save results to')
+    parser.add_argument('--compare', help='path of JSON file with results to compare against')
+    parser.add_argument('--threshold', type=float, default=1.1,
+                        help='slowdown ratio reported as a regression (default: 1.1)')
+    args = parser.parse_args()
+
+    # Run every benchmark
+    results = []
+    for state in args.states.split(','):
+        results += benchmark_state(state, *STATES[state], args.plans, args.repeat)
+    results += benchmark_scaling(args.national, args.repeat)
+
+    # Display the results
+    print_results(results)
+
+    # Save the results with enough context to compare them later
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f, indent=1)
+
+    # Compare against earlier results and fail if anything regressed
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)['results']
+        if compare_results(old, results, args.threshold):
+            sys.exit(1)
+    return
+
+
+def synthetic_state(n_blocks, n_lcltys, n_districts, seed=0):
+    """Make a block table shaped like a real state.
+
+    Localities have very different sizes, about a quarter of blocks have no
+    population, and districts are runs of blocks with equal population, so
+    they split some localities and not others.
+
+    Arguments:
+        n_blocks: number of census blocks
+        n_lcltys: number of localities (e.g. counties)
+        n_districts: number of districts
+        seed: random seed
+
+    Output: (pops, lclty, rng) where rng can draw plans with synthetic_plan()
+    """
+    rng = np.random.default_rng(seed)
+
+    # Give localities heavy-tailed sizes and lay their blocks out in runs
+    shares = rng.pareto(1.2, n_lcltys) + 1
+    counts = rng.multinomial(n_blocks - n_lcltys, shares / shares.sum()) + 1
+    lclty = np.repeat(np.arange(n_lcltys), counts)
+
+    # Give a quarter of blocks no population and the rest heavy-tailed populations
+    pops = rng.geometric(1 / 40, n_blocks) * (rng.random(n_blocks) > 0.25)
+    return pops, lclty, rng
+
+
+def synthetic_plan(pops, n_districts, rng, jitter=500):
+    """Draw a plan of equal-population districts over a synthetic state.
+
+    Districts are runs of blocks in a jittered version of the block order, so
+    different draws move district lines around like an ensemble would.
+    """
+    # Jitter the order of the blocks
+    order = np.argsort(np.arange(len(pops)) + rng.normal(0, jitter, len(pops)))
+
+    # Cut the jittered order into runs of equal population
+    cumulative = np.cumsum(pops[order]) / max(pops.sum(), 1)
+    plan = np.empty(len(pops), dtype=np.int64)
+    plan[order] = np.minimum((cumulative * n_districts).astype(np.int64), n_districts - 1)
+    return plan
+
+
+def measure(name, case, func, repeat, work, unit):
+    """Time a function and measure its peak memory.
+
+    Arguments:
+        name: name of the benchmark
+        case: dictionary describing the inputs
+        func: function of no arguments to benchmark
+        repeat: number of timed runs
+        work: amount of work done by one run, in units of unit
+        unit: what work counts (e.g. 'blocks', 'plans')
+
+    Output: dictionary of results
+    """
+    # Warm up, then time separate runs
+    func()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    # Measure peak memory allocated in a separate run, since tracing slows things down
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    median = float(np.median(times))
+    return {'benchmark': name, **case, 'repeat': repeat,
+            'best_s': min(times), 'median_s': median,
+            'throughput': work / median, 'unit': unit + '/s',
+            'peak_mb': peak / 2 ** 20}
+
+
+def benchmark_state(state, n_blocks, n_lcltys, n_districts, n_plans, repeat):
+    """Benchmark every entry point on one synthetic state."""
+    print(f'Benchmarking {state}...', file=sys.stderr)
+    case = {'state': state, 'blocks': n_blocks, 'localities': n_lcltys, 'districts': n_districts}
+    pops, lclty, rng = synthetic_state(n_blocks, n_lcltys, n_districts)
+    plan = synthetic_plan(pops, n_districts, rng)
+    df = pd.DataFrame({'lclty': lclty, 'plan': plan, 'pop': pops})
+    results = []
+
+    # Score a single plan
+    results.append(measure('calculate_all_metrics', case,
+                           lambda: metrics.calculate_all_metrics(df, 'plan', lclty_col='lclty'),
+                           repeat, n_blocks, 'blocks'))
+    results.append(measure('contingency', case,
+                           lambda: metrics.Contingency.from_dataframe(df, 'plan', lclty_col='lclty'),
+                           repeat, n_blocks, 'blocks'))
+
+    # Score each metric function on its own, from grouped intersections and from a table
+    grouped = df.groupby(['lclty', 'plan'], as_index=False).agg({'pop': 'sum'})
+    grouped['pop'] = grouped['pop'].astype(float)
+    table = metrics.Contingency.from_dataframe(df, 'plan', lclty_col='lclty')
+    for function, agg_exponent in METRIC_FUNCTIONS:
+        results.append(measure('calculate_metric.' + function.__name__, case,
+                               lambda: metrics.calculate_metric(grouped, 'lclty', 'pop', function,
+                                                                agg_exponent),
+                               repeat, len(grouped), 'intersections'))
+        results.append(measure('contingency_score.' + function.__name__, case,
+                               lambda: metrics.Contingency(table.indptr, table.indices, table.data,
+                                                           table.row_labels, table.col_labels
+                                                           ).score(function, agg_exponent),
+                               repeat, table.nnz, 'intersections'))
+
+    # Score an ensemble of plans
+    assignments = np.vstack([synthetic_plan(pops, n_districts, rng) for _ in range(n_plans)])
+    results.append(measure('calculate_ensemble_metrics', {**case, 'plans': n_plans},
+                           lambda: metrics.calculate_ensemble_metrics(pops, lclty, assignments),
+                           repeat, n_plans, 'plans'))
+
+    # Move a single block at a time
+    scorer = metrics.IncrementalScorer(pops, lclty, plan)
+    blocks = rng.integers(0, n_blocks, 100)
+    districts = rng.integers(0, n_districts, 100)
+    results.append(measure('incremental_move', case,
+                           lambda: [scorer.move([(b, d)]) for b, d in zip(blocks, districts)],
+                           repeat, len(blocks), 'moves'))
+    return results
+
+
+def benchmark_scaling(national, repeat):
+    """Benchmark calculate_all_metrics over growing numbers of blocks, localities and districts."""
+    print('Benchmarking scaling...', file=sys.stderr)
+    results = []
+
+    # Grow the number of blocks, up to a national-size table if asked
+    sizes = [10 ** 4, 10 ** 5, 10 ** 6] + ([NATION[0]] if national else [])
+    shapes = [(n, 60, 50) for n in sizes]
+    if national:
+        shapes[-1] = NATION
+
+    # Grow the number of localities and the number of districts
+    shapes += [(200000, n, 50) for n in [1, 10, 100, 254]]
+    shapes += [(200000, 60, n) for n in [1, 10, 100, 150]]
+
+    for n_blocks, n_lcltys, n_districts in shapes:
+        case = {'blocks': n_blocks, 'localities': n_lcltys, 'districts': n_districts}
+        pops, lclty, rng = synthetic_state(n_blocks, n_lcltys, n_districts)
+        df = pd.DataFrame({'lclty': lclty, 'plan': synthetic_plan(pops, n_districts, rng), 'pop': pops})
+        results.append(measure('scaling.calculate_all_metrics', case,
+                               lambda: metrics.calculate_all_metrics(df, 'plan', lclty_col='lclty'),
+                               max(1, repeat // 2), n_blocks, 'blocks'))
+    return results
+
+
+def result_key(result):
+    """Identify a benchmark result across runs."""
+    return (result['benchmark'], result.get('state'), result['blocks'],
+            result['localities'], result['districts'], result.get('plans'))
+
+
+def print_results(results):
+    """Print results as a table."""
+    df = pd.DataFrame(results)
+    cols = ['benchmark', 'state', 'blocks', 'localities', 'districts',
+            'median_s', 'throughput', 'unit', 'peak_mb']
+    with pd.option_context('display.max_rows', None, 'display.width', 200):
+        print(df[[col for col in cols if col in df.columns]].to_string(index=False))
+
+
+def compare_results(old, new, threshold):
+    """Print the slowdown of every benchmark found in both sets of results.
+
+    Output: list of keys of benchmarks that got slower than the threshold ratio
+    """
+    old = {result_key(result): result for result in old}
+    regressions = []
+    print('\nmedian time relative to previous results:')
+    for result in new:
+        key = result_key(result)
+        if key not in old:
+            continue
+        ratio = result['median_s'] / old[key]['median_s']
+        flag = '  <-- regression' if ratio > threshold else ''
+        print(f'{ratio:6.2f}x  {key}{flag}')
+        if ratio > threshold:
+            regressions.append(key)
+    return regressions
+
+
+def environment():
+    """Describe the machine and versions the benchmarks ran with."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(),
+            'numpy': np.__version__, 'pandas': pd.__version__,
+            'machine': platform.machine(), 'processor': platform.processor(),
+            'cpus': os.cpu_count()}
+
+
+if __name__ == "__main__":
+    main()
@@ -2,9 +2,21 @@ import pandas as pd
 import requests
 from io import BytesIO
 from zipfile import ZipFile
+import hashlib
+import json
 import math
+import numpy as np
+import os
+import re
+import time
 import us
 
+# directory of downloaded .zip files, unless another is passed or set in the environment
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'locality_splitting')
+
+# base web path for all block equivalency files (can be pointed at a mirror or a local test server)
+BEF_BASE_URL = 'https://www2.census.gov/programs-surveys/decennial/rdo/mapping-files'
+
 def congress(election_year):
     """ Return the number of the Congress (e.g., 115th) corresponding to the election year (e.g., 2016)."""
     return math.floor(election_year / 2) - 893
@@ -27,7 +39,7 @@ def get_url(year, plan_type):
         raise ValueError("Data only available for 2012, 2014, 2016, 2018 elections")
 
     # initialize base web path for all of this data
-    path = 'https://www2.census.gov/programs-surveys/decennial/rdo/mapping-files'
+    path = BEF_BASE_URL
 
     # if congressional plan
     if plan_type == 'cd':
@@ -49,75 +61,344 @@ def get_url(year, plan_type):
     return url
 
 
-def get_block_equivalency_file(year, plan_type):
+def get_block_equivalency_file(year, plan_type, states=None, cache_dir=None, offline=False, local_dir=None,
+                               session=None):
     """ Get block equivalency file from U.S Census.
 
     Arguments:
         year: election year
         plan_type: one of cd (for congressional districts), sldu (for state upper chamber), or
             sldl (for state lower chamber)
-    Output: pandas DataFrame with a column for census block GEOID and district name
+        states: state name, abbreviation, or FIPS code, or a list of them, to only keep the blocks of those
+            states (filtered while decompressing, so only their rows ever get parsed)
+        cache_dir, offline, local_dir, session: how to download and where to keep and find the .zip file,
+            see download_zip
+    Output: pandas DataFrame with a column for census block GEOID (as strings) and district name (as a
+        categorical)
     """
 
     # get url to read .zip file from
     url = get_url(year, plan_type)
 
-    # read in zip file from url
-    content = requests.get(url)
-    f = ZipFile(BytesIO(content.content))
+    # get the zip file from the cache, or download it
+    path = download_zip(url, cache_dir=cache_dir, offline=offline, local_dir=local_dir, session=session)
+    with ZipFile(path) as f:
 
-    # find the national file in the zipped archive
-    natl_files = [filename for filename in f.namelist() if 'National' in filename]
-    if len(natl_files) != 1:
-        raise ValueError("Did not find exactly one file with 'National' in name")
+        # find the national file in the zipped archive
+        natl_files = [filename for filename in f.namelist() if 'National' in filename]
+        if len(natl_files) != 1:
+            raise ValueError("Did not find exactly one file with 'National' in name")
 
-    # open national file
-    file = f.open(natl_files[0])
+        # open national file, keeping only the lines of the given states if any
+        with f.open(natl_files[0]) as file:
+            if states is not None:
+                if isinstance(states, (str, int)):
+                    states = [states]
+                prefixes = [state_fips(state).encode() for state in states]
+                file = BytesIO(b''.join(filter_lines(file, prefixes)))
+
+            # read file to pandas DataFrame, format district column
+            df = pd.read_csv(file, dtype=str, usecols=[0, 1])
 
-    # read file to pandas DataFrame, format district column
-    df = pd.read_csv(file, dtype=str, usecols=[0, 1])
     df.columns = [df.columns[0], f'{plan_type}_{year}']
+    df[df.columns[1]] = df[df.columns[1]].astype('category')
 
     return df
 
 
-def merge_state_census_block_pops(state, block_equiv_file):
-    """ Merge populations into a block equivalency file
+def get_block_equivalency_files(plans, states=None, max_workers=4, retries=3, backoff=1.0, progress=None,
+                                session=None, cache_dir=None, offline=False, local_dir=None):
+    """ Get the block equivalency files of many plans at once, downloading them concurrently.
+
+    Downloads share one session, which keeps connections alive and retries failed requests, and each
+    plan is tried again with exponential backoff if its download is cut off.
 
     Arguments:
-        state: state name, abbreviation, or FIPS code
-        block_equiv_file: pandas DataFrame outputted by get_block_equivalency_file()
-            with a BLOCKID column and a column for the district
-    Output: block_equiv_file sliced down to the given state, with a population column added
+        plans: list of (year, plan_type) pairs, e.g. [(2016, 'cd'), (2018, 'sldu')]
+        states: states to keep, see get_block_equivalency_file
+        max_workers: number of files to download at once
+        retries: number of times to retry each plan (and each request) after a failure
+        backoff: seconds to wait before the first retry, doubling after each one
+        progress: True to print a line as each plan finishes, or a function called with (number done,
+            number of plans, (year, plan_type))
+        session: object with a requests-like get() method to download with, e.g. to test against a local
+            server (defaults to make_session(retries, backoff, max_workers))
+        cache_dir, offline, local_dir: where to keep and find the downloaded .zip files, see download_zip
+    Output: dictionary with the DataFrame of every (year, plan_type) pair, see get_block_equivalency_file
     """
 
-    # get FIPS code
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    plans = list(dict.fromkeys((year, plan_type) for year, plan_type in plans))
+    if session is None:
+        session = make_session(retries=retries, backoff=backoff, pool_size=max_workers)
+
+    def fetch(year, plan_type):
+        for attempt in range(retries + 1):
+            try:
+                return get_block_equivalency_file(year, plan_type, states=states, cache_dir=cache_dir,
+                                                  offline=offline, local_dir=local_dir, session=session)
+            except (requests.RequestException, OSError):
+                if offline or attempt == retries:
+                    raise
+                time.sleep(backoff * 2 ** attempt)
+
+    # download the plans in a pool of threads, reporting each one as it finishes
+    dfs = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fetch, year, plan_type): (year, plan_type) for year, plan_type in plans}
+        for future in as_completed(futures):
+            plan = futures[future]
+            dfs[plan] = future.result()
+            if progress is True:
+                print(f'{len(dfs)}/{len(plans)} {plan[1]}_{plan[0]}')
+            elif progress:
+                progress(len(dfs), len(plans), plan)
+
+    # keep the order the plans were asked for in
+    return {plan: dfs[plan] for plan in plans}
+
+
+def make_session(retries=3, backoff=1.0, pool_size=10):
+    """ Make a requests Session that keeps connections alive and retries failed requests.
+
+    Arguments:
+        retries: number of times to retry a request that fails to connect or gets a server error
+        backoff: seconds to wait before the first retry, doubling after each one
+        pool_size: number of connections to keep alive for each host
+    Output: requests Session
+    """
+
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=['GET', 'HEAD'])
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def filter_lines(file, prefixes, chunk_bytes=1 << 22):
+    """ Read a text file in chunks, keeping the header and the lines that start with any of the prefixes.
+
+    Lines are split and matched with array operations on each chunk of bytes, so the lines that don't
+    match are never decoded or parsed. A double quote before the prefix is ignored.
+
+    Arguments:
+        file: file object opened in binary mode, e.g. a member of a zip file
+        prefixes: list of byte strings, e.g. [b'01', b'02'] for states by FIPS code
+        chunk_bytes: number of bytes to decompress and filter at a time
+    Output: generator of byte strings, the header and then the matching lines of each chunk
+    """
+
+    yield file.readline()
+
+    rest = b''
+    while True:
+        chunk = file.read(chunk_bytes)
+        if not chunk:
+            break
+
+        # filter the complete lines, and carry over the last partial line to the next chunk
+        chunk = rest + chunk
+        end = chunk.rfind(b'\n') + 1
+        rest = chunk[end:]
+        if end:
+            yield _matching_lines(chunk[:end], prefixes)
+
+    # filter a last line without a newline at the end
+    if rest:
+        yield _matching_lines(rest + b'\n', prefixes)
+
+
+def _matching_lines(chunk, prefixes):
+    """ Return the lines of a chunk of bytes ending in a newline that start with any of the prefixes."""
+
+    if not chunk:
+        return b''
+    data = np.frombuffer(chunk, dtype=np.uint8)
+
+    # find where every line starts and ends, skipping a leading quote
+    ends = np.flatnonzero(data == ord('\n'))
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    first = starts + (data[starts] == ord('"'))
+
+    # check each byte of each prefix against the start of every line
+    keep = np.zeros(len(starts), dtype=bool)
+    for prefix in prefixes:
+        matches = first + len(prefix) <= ends
+        for i, byte in enumerate(prefix):
+            matches &= data[np.minimum(first + i, len(data) - 1)] == byte
+        keep |= matches
+
+    # keep the bytes of the matching lines
+    return data[np.repeat(keep, ends - starts + 1)].tobytes()
+
+
+def download_zip(url, cache_dir=None, offline=False, local_dir=None, session=None):
+    """ Get the path to a local copy of a .zip file, downloading it only if it isn't cached or has changed.
+
+    Downloads are kept in cache_dir, keyed by URL, with the checksum, ETag and Last-Modified date of each.
+    A cached file is checked against its checksum and revalidated with the server, so it only gets
+    downloaded again if it changed. If the server can't be reached, the cached file is used.
+
+    Arguments:
+        url: URL of the .zip file
+        cache_dir: directory for downloaded files (defaults to the LOCALITY_SPLITTING_CACHE environment
+            variable, or ~/.cache/locality_splitting)
+        offline: if True, never go online, and use the cached file or the file with the same name in
+            local_dir
+        local_dir: directory of .zip files downloaded by hand, named as in the URLs (e.g. cd115.zip)
+        session: object with a requests-like get() method to download with (defaults to requests itself)
+    Output: path to the .zip file
+    """
+
+    # use a file downloaded by hand if there is one
+    name = url.rsplit('/', 1)[-1]
+    if local_dir is not None and os.path.isfile(os.path.join(local_dir, name)):
+        return os.path.join(local_dir, name)
+
+    # find where the file is cached
+    cache_dir = _cache_dir(cache_dir)
+    key = hashlib.sha256(url.encode()).hexdigest()[:16]
+    path = os.path.join(cache_dir, f'{key}_{name}')
+    meta = _read_cache_meta(path)
+
+    # serve the cached file without going online in offline mode
+    if offline:
+        if meta is None:
+            raise FileNotFoundError(f'{url} is not cached in {cache_dir} or found in local_dir')
+        return path
+
+    # ask the server for the file, unless it's the same as the cached one
+    headers = {}
+    if meta is not None:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+    try:
+        response = (session or requests).get(url, headers=headers, stream=True, timeout=60)
+    except requests.RequestException:
+        if meta is not None:
+            return path
+        raise
+
+    with response:
+        if response.status_code == 304 and meta is not None:
+            return path
+        response.raise_for_status()
+
+        # write the file under a temporary name while taking its checksum, then move it into place
+        digest = hashlib.sha256()
+        with open(path + '.part', 'wb') as f:
+            for chunk in response.iter_content(chunk_size=1 << 20):
+                digest.update(chunk)
+                f.write(chunk)
+        os.replace(path + '.part', path)
+
+        # remember how to revalidate and check the file
+        meta = {'url': url, 'sha256': digest.hexdigest(), 'size': os.path.getsize(path),
+                'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+        with open(path + '.json.part', 'w') as f:
+            json.dump(meta, f)
+        os.replace(path + '.json.part', path + '.json')
+
+    return path
+
+
+def _read_cache_meta(path):
+    """ Return the metadata of a cached file, or None if it isn't cached or doesn't match its checksum."""
+
+    try:
+        with open(path + '.json') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    # check the file is all there and unchanged
+    if not os.path.isfile(path) or os.path.getsize(path) != meta.get('size'):
+        return None
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    if digest.hexdigest() != meta.get('sha256'):
+        return None
+    return meta
+
+
+def state_fips(state):
+    """ Return the two-digit FIPS code of a state given by name, abbreviation, or FIPS code."""
+
     if not isinstance(state, str): # if user appears to provide a FIPS code, make sure it's properly formatted
         state = str(state).zfill(2)
     try:
-        fips_code = us.states.lookup(state).fips
+        return us.states.lookup(state).fips
     except AttributeError:
         raise ValueError("Invalid state name provided.")
 
-    # get census API query
-    base = 'https://api.census.gov/data/2010/dec/sf1'
-    variables = '?get=P001001,GEO_ID'
-    level = '&for=block:*'
-    hierarchy = '&in=state:' + fips_code + '&in=county:*&in=tract:*'
-    query = base + variables + level + hierarchy
 
-    # query census for population
-    data = requests.get(query).json()
+def merge_state_census_block_pops(state, block_equiv_file, cache_dir=None, offline=False, session=None,
+                                  census_key=None):
+    """ Merge populations into a block equivalency file
+
+    Arguments:
+        state: state name, abbreviation, or FIPS code
+        block_equiv_file: pandas DataFrame outputted by get_block_equivalency_file()
+            with a BLOCKID column and a column for the district
+        cache_dir, offline, session, census_key: see get_census_block_pops
+    Output: block_equiv_file sliced down to the given state, with a population column added
+    """
+
+    return merge_census_block_pops(block_equiv_file, states=[state], cache_dir=cache_dir, offline=offline,
+                                   session=session, census_key=census_key)
+
 
-    # make population DataFrame and do some basic cleaning
-    df = pd.DataFrame(data[1:], columns=data[0]).iloc[:, :2]
-    df.columns = ['pop', 'BLOCKID']
-    df = df[['BLOCKID', 'pop']]
-    df['pop'] = df['pop'].astype(float)
-    df['BLOCKID'] = df['BLOCKID'].apply(lambda x: x.split('S')[1])
+def merge_census_block_pops(block_equiv_file, states=None, max_workers=4, cache_dir=None, offline=False,
+                            session=None, census_key=None):
+    """ Merge populations of every state (or the given ones) into a block equivalency file in one join.
+
+    Arguments:
+        block_equiv_file: pandas DataFrame outputted by get_block_equivalency_file()
+            with a BLOCKID column and a column for the district
+        states: list of state names, abbreviations, or FIPS codes (defaults to every state in the file)
+        max_workers: number of states to get populations for at once
+        cache_dir, offline, session, census_key: see get_census_block_pops
+    Output: block_equiv_file sliced down to the blocks of the states, with a population column added
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    # find the blocks of the file by integer ID
+    bef_ids = block_ids(block_equiv_file['BLOCKID'])
+    if states is None:
+        fips_codes = [f'{code:02d}' for code in np.unique(bef_ids // 10 ** 13)]
+    else:
+        fips_codes = [state_fips(state) for state in states]
 
-    # merge populations and block equivalency file
-    merged = pd.merge(df, block_equiv_file, how='left', on='BLOCKID')
+    # get the populations of every state
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        dfs = list(executor.map(lambda fips_code: get_census_block_pops(fips_code, cache_dir=cache_dir,
+                                                                        offline=offline, session=session,
+                                                                        census_key=census_key),
+                                fips_codes))
+    df = pd.concat(dfs, ignore_index=True)
+
+    # make population DataFrame with block GEOIDs as strings
+    merged = pd.DataFrame({'BLOCKID': pd.Series(df['block_id'].to_numpy()).astype(str).str.zfill(15),
+                           'pop': df['pop'].astype(float)})
+
+    # merge populations and block equivalency file, looking up blocks by integer ID
+    districts = block_equiv_file.drop(columns='BLOCKID').set_axis(bef_ids)
+    if not districts.index.is_unique:
+        raise ValueError('Block equivalency file has repeated blocks')
+    districts = districts.reindex(df['block_id'].to_numpy())
+    for col in districts.columns:
+        merged[col] = districts[col].array
 
     # drop census blocks not in a district (these are unpopulated)
     district_col = block_equiv_file.columns[1]
@@ -128,3 +409,163 @@ def merge_state_census_block_pops(state, block_equiv_file):
         raise ValueError('Failed to merge in all district names')
 
     return merged
+
+
+def get_census_block_pops(state, cache_dir=None, offline=False, session=None, census_key=None):
+    """ Get the 2010 census population of every block of a state, from a local cache or the Census API.
+
+    Populations are cached as columns in a .npz file per state, so every state only gets queried once.
+
+    Arguments:
+        state: state name, abbreviation, or FIPS code
+        cache_dir: directory for cached populations, see download_zip
+        offline: if True, only use cached populations
+        session: object with a requests-like get() method to query with (defaults to requests itself)
+        census_key: optional census API key
+    Output: pandas DataFrame with an integer block GEOID (block_id) and integer population (pop) for every
+        block
+    """
+
+    # find where the populations are cached
+    fips_code = state_fips(state)
+    path = os.path.join(_cache_dir(cache_dir), f'block_pops_2010_{fips_code}.npz')
+
+    # query census for population, unless it's cached
+    if not os.path.isfile(path):
+        if offline:
+            raise FileNotFoundError(f'Block populations of state {fips_code} are not cached in {path}')
+
+        # get census API query
+        base = 'https://api.census.gov/data/2010/dec/sf1'
+        variables = '?get=P001001,GEO_ID'
+        level = '&for=block:*'
+        hierarchy = '&in=state:' + fips_code + '&in=county:*&in=tract:*'
+        query = base + variables + level + hierarchy
+        if census_key:
+            query += '&key=' + census_key
+
+        # parse the response as it streams in, into integer populations and GEOIDs
+        with (session or requests).get(query, stream=True, timeout=600) as response:
+            response.raise_for_status()
+            columns = read_census_json(response.iter_content(chunk_size=1 << 22), columns=['P001001', 'GEO_ID'],
+                                       dtypes={'P001001': np.int64, 'GEO_ID': 'geoid'})
+
+        # never cache a state without blocks
+        if len(columns['GEO_ID']) == 0:
+            raise ValueError(f'Census API returned no blocks for state {fips_code}')
+
+        # write the cache under a temporary name, then move it into place
+        with open(path + '.part', 'wb') as f:
+            np.savez(f, block_id=columns['GEO_ID'], pop=columns['P001001'])
+        os.replace(path + '.part', path)
+
+    with np.load(path) as f:
+        return pd.DataFrame({'block_id': f['block_id'], 'pop': f['pop']})
+
+
+def read_census_json(chunks, columns=None, dtypes=None, min_bytes=1 << 20):
+    """ Parse a Census API response incrementally into a column for each variable.
+
+    The response is a JSON array of rows of strings, the first one naming the columns. Rows are parsed
+    a chunk at a time as the response streams in, straight into typed columns, so the response never
+    has to be held in memory or turned into Python lists. A response that isn't such an array (e.g. an
+    error page) or that is cut off raises a ValueError.
+
+    Arguments:
+        chunks: iterable of byte strings making up the response, e.g. response.iter_content(1 << 22)
+        columns: list of names of the columns to keep (defaults to all of them)
+        dtypes: dictionary of numpy dtypes of columns, or 'geoid' to parse GEO_IDs into integer block GEOIDs
+            (see block_ids); other columns are kept as strings
+        min_bytes: number of bytes of rows to collect before parsing them
+    Output: dictionary with an array for every column
+    """
+
+    dtypes = dtypes or {}
+    header = None
+    buffer = bytearray()
+    parts = []
+
+    for chunk in chunks:
+        buffer += chunk
+
+        # read the names of the columns from the first row
+        if header is None:
+            if buffer.strip() and not buffer.lstrip().startswith(b'['):
+                raise ValueError(f'Census API response is not a JSON array: {_snippet(buffer)}')
+            first_end = buffer.find(b']')
+            if first_end < 0:
+                continue
+            first_start = buffer.find(b'[', buffer.find(b'[') + 1)
+            if not 0 <= first_start < first_end:
+                raise ValueError(f'Census API response has no header row: {_snippet(buffer)}')
+            header = json.loads(buffer[first_start:first_end + 1])
+            if not all(isinstance(name, str) for name in header):
+                raise ValueError(f'Census API response has no header row: {_snippet(buffer)}')
+            buffer = buffer[first_end:]
+            if columns is None:
+                columns = header
+
+        # parse the complete rows once enough have come in, up to the last row separator so the closing
+        # bracket of the whole array is left for the check below
+        end = buffer.rfind(b'],') if len(buffer) >= min_bytes else -1
+        if end > 0:
+            parts.append(_parse_census_rows(buffer[:end], header, columns, dtypes))
+            buffer = buffer[end:]
+
+    # check the whole response came in
+    if header is None:
+        raise ValueError(f'Census API response has no header row: {_snippet(buffer)}')
+    if not buffer.rstrip().endswith(b']]'):
+        raise ValueError(f'Census API response is cut off: {_snippet(buffer[-200:])}')
+
+    parts.append(_parse_census_rows(buffer, header, columns, dtypes))
+    return {col: np.concatenate([part[col] for part in parts]) for col in columns}
+
+
+def _snippet(text):
+    """ Return the start of a response, for error messages."""
+
+    return bytes(text[:200]).decode(errors='replace').strip() or '(empty)'
+
+
+def _parse_census_rows(text, header, columns, dtypes):
+    """ Parse rows of a Census API response, each starting with the end of the previous row."""
+
+    # turn the rows into lines of comma-separated values
+    text = re.sub(rb'\]\s*,\s*\[', b'\n', text).translate(None, b'[]"')
+    if not text.strip():
+        return {col: np.array([], dtype=_column_dtype(dtypes.get(col))) for col in columns}
+
+    # read the lines, with integer columns parsed straight into integers
+    read_dtypes = {col: str if dtypes.get(col, str) in ('geoid', str) else dtypes[col] for col in columns}
+    df = pd.read_csv(BytesIO(text), header=None, names=header, usecols=columns, dtype=read_dtypes,
+                     na_filter=False, skipinitialspace=True)
+
+    return {col: block_ids(df[col]) if dtypes.get(col) == 'geoid' else df[col].to_numpy() for col in columns}
+
+
+def _column_dtype(dtype):
+    """ Return the numpy dtype of a column parsed by read_census_json."""
+
+    if dtype == 'geoid':
+        return np.int64
+    return object if dtype in (None, str) else dtype
+
+
+def block_ids(geoids):
+    """ Convert block GEOIDs (e.g. '090010201001000', or GEO_IDs like '1000000US090010201001000') to
+    64-bit integers, as a numpy array."""
+
+    geoids = pd.Series(geoids)
+    if len(geoids) == 0:
+        return np.array([], dtype=np.int64)
+    return geoids.astype(str).str.slice(-15).astype(np.int64).to_numpy()
+
+
+def _cache_dir(cache_dir=None):
+    """ Return the cache directory, creating it if needed (see download_zip)."""
+
+    if cache_dir is None:
+        cache_dir = os.environ.get('LOCALITY_SPLITTING_CACHE', DEFAULT_CACHE_DIR)
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
@@ -2,6 +2,8 @@
 import urllib.request as url
 import requests
 import os
+import sys
+import numpy as np
 import pandas as pd
 from fips_lookup import state_fips
 
@@ -19,6 +21,9 @@ def main():
     not using the combined file and using the and api to join population to
     geography to make transitioning to 2020 census data easier
     """
+    # Make the modules in the main folder of the repository importable
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
     # Get list of state fips
     fips = state_fips()
 
@@ -173,6 +178,9 @@ def extract_census_block_statistics(fips, census_key=False):
 
         census_key: optional census API key
     """
+    # Parse responses with the reader in the main folder (see main)
+    from block_equivalency_file import read_census_json
+
     # Display that we are extracting census block populations
     print('EXTRACTING CENSUS BLOCK POPULATIONS------------------------\n\n')
 
@@ -202,8 +210,12 @@ def extract_census_block_statistics(fips, census_key=False):
             if not os.path.isfile(output):
                 print(output)
                 try:
-                    data = requests.get(query).json()
-                    df = pd.DataFrame(data[1:], columns=data[0])
+                    # parse the response as it streams in, with populations as integers
+                    with requests.get(query, stream=True) as response:
+                        response.raise_for_status()
+                        columns = read_census_json(response.iter_content(chunk_size=1 << 22),
+                                                   dtypes={'P001001': np.int64})
+                    df = pd.DataFrame(columns)
                     df.to_csv(output, index=False)
                 # Keep as bare except for now for testing functionality
                 except:
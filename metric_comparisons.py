@@ -0,0 +1,97 @@
+"""Compare how locality splitting metrics rank changes between plans."""
+
+import numpy as np
+import pandas as pd
+
+
+def metric_changes(df, metrics, group_cols=('state', 'plan_type'), order_col='year'):
+    """Calculates how every metric changed between consecutive plans of each group.
+
+    Arguments:
+        df: pandas DataFrame in long format, with a row for every plan (e.g. the output of
+            calculate_all_metrics for many plans), its group columns, order column and metrics
+        metrics: names of the metric columns
+        group_cols: columns identifying a series of plans (e.g. a state's congressional plans)
+        order_col: column ordering the plans within each group
+
+    Output:
+        pandas DataFrame with a row for every pair of consecutive plans in a group, indexed by the
+        group columns, with the score of the earlier plan minus the score of the later one for every
+        metric
+    """
+
+    group_cols = list(group_cols)
+    metrics = list(metrics)
+
+    # sort the plans by group, then by order within each group
+    df = df.sort_values(group_cols + [order_col], kind='stable')
+    values = df[metrics].to_numpy(dtype=float)
+    groups = df.groupby(group_cols, sort=False).ngroup().to_numpy()
+
+    # take the difference of every plan and the next one in the same group
+    same_group = groups[:-1] == groups[1:]
+    changes = values[:-1][same_group] - values[1:][same_group]
+
+    index = pd.MultiIndex.from_frame(df[group_cols].iloc[:-1][same_group])
+    return pd.DataFrame(changes, index=index, columns=metrics)
+
+
+def metric_match_matrix(df, metrics, group_cols=('state', 'plan_type'), order_col='year'):
+    """Calculates how often every pair of metrics agrees on whether consecutive plans got better or worse.
+
+    For every pair of consecutive plans in a group (see metric_changes) and every pair of metrics, the
+    metrics match if both of their scores went up or both went down. Pairs of plans where either metric
+    is unchanged (or missing) are left out of that pair of metrics' sample.
+
+    Arguments:
+        df: pandas DataFrame in long format, see metric_changes
+        metrics: names of the metric columns
+        group_cols: columns identifying a series of plans
+        order_col: column ordering the plans within each group
+
+    Output:
+        (proportions, sample_sizes) pandas DataFrames with a row and a column for every metric: the
+        proportion of pairs of plans where the two metrics match, and the number of pairs of plans where
+        neither metric is unchanged
+    """
+
+    changes = metric_changes(df, metrics, group_cols, order_col).to_numpy()
+
+    # count the pairs of plans where both metrics went up, both went down, and neither is unchanged
+    up = (changes > 0).astype(np.int64)
+    down = (changes < 0).astype(np.int64)
+    matches = up.T @ up + down.T @ down
+    sample_sizes = (up + down).T @ (up + down)
+
+    # the proportion of matches is undefined without any pairs of plans
+    with np.errstate(divide='ignore', invalid='ignore'):
+        proportions = np.where(sample_sizes > 0, matches / sample_sizes, np.nan)
+
+    index = pd.Index(list(metrics))
+    return (pd.DataFrame(proportions, index=index, columns=index),
+            pd.DataFrame(sample_sizes, index=index, columns=index))
+
+
+def symmetric_match_rates(df, metrics, group_cols=('state', 'plan_type'), order_col='year'):
+    """Calculates how often every metric agrees with its symmetric version (named metric + '_sym'), see
+    metric_match_matrix.
+
+    Output:
+        pandas DataFrame with a row for every metric, with the proportion of matches ('match_proportion')
+        and the number of pairs of plans where neither version is unchanged ('sample_size')
+    """
+
+    metrics = list(metrics)
+    changes = metric_changes(df, metrics + [metric + '_sym' for metric in metrics], group_cols, order_col)
+    changes = changes.to_numpy()
+    asym, sym = changes[:, :len(metrics)], changes[:, len(metrics):]
+
+    # count the pairs of plans where both versions moved the same way, and where neither is unchanged
+    matches = ((asym > 0) & (sym > 0) | (asym < 0) & (sym < 0)).sum(axis=0)
+    sample_sizes = ((asym != 0) & (sym != 0) & ~np.isnan(asym) & ~np.isnan(sym)).sum(axis=0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        proportions = np.where(sample_sizes > 0, matches / sample_sizes, np.nan)
+
+    return pd.DataFrame({'match_proportion': proportions, 'sample_size': sample_sizes},
+                        index=pd.Index(metrics))
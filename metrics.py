@@ -1,11 +1,29 @@
 """Calculate various locality splitting metrics."""
 
+import collections
+import contextlib
+import contextvars
+import functools
+import hashlib
+import json
+import mmap
+import os
+import time
+import tracemalloc
+import types
+
 import numpy as np
+import pandas as pd
 
 
-def calculate_all_metrics(df, plan_col, state=None, lclty_col='COUNTYFP10', pop_col='pop'):
+def calculate_all_metrics(df, plan_col, state=None, lclty_col='COUNTYFP10', pop_col='pop', metrics=None,
+                          cache=None):
     """Calculate all metrics and return in a dictionary.
 
+    df can be a pandas DataFrame, a pyarrow Table or RecordBatch, or a dictionary
+    of arrays, with a row for every block. See calculate_array_metrics to pass
+    the columns as arrays instead.
+
     Below are the names of the metrics. See docstrings below for more
     in-depth descriptions
 
@@ -18,63 +36,1018 @@ def calculate_all_metrics(df, plan_col, state=None, lclty_col='COUNTYFP10', pop_
         min_entropy: see function
         sqrt_entropy: see function
         effective_splits: see function
+
+    Symmetric versions of the metrics get the suffix '_sym'. Pass a list of names
+    as metrics to calculate only those, and see register_metric to add metrics.
+
+    Pass a list of population columns as pop_col (e.g. total population, voting
+    age population and citizen voting age population) to score the plan with
+    each of them as weights at once. The output is then a dictionary with the
+    dictionary of metrics for each population column.
+
+    Pass a MetricsCache as cache to reuse the metrics of tables scored before, and
+    see compress_blocks to score several plans of the same blocks faster.
         """
 
-    # get populations of each (locality, district) pair
-    df = df.groupby([lclty_col, plan_col], as_index=False).agg({pop_col: sum})
-
-    # make pop_col a float because big ints introduce bugs
-    df[pop_col] = df[pop_col].astype(float)
-
-    # Initialize dictionary with state and plan names
-    d = {}
-
-    if state is not None:
-        d['state'] = state
-    d['plan'] = plan_col
-
-    # Calculate total number of localities split
-    d['splits_all'] = calculate_metric(df, lclty_col, pop_col, localities_split, None,
-                                       populated=False)
-    d['splits_pop'] = calculate_metric(df, lclty_col, pop_col, localities_split, None)
-
-    # Calculate total number of locality district intersections
-    d['intersections_all'] = calculate_metric(df, lclty_col, pop_col, locality_intersections,
-                                              None, populated=False)
-    d['intersections_pop'] = calculate_metric(df, lclty_col, pop_col, locality_intersections,
-                                              None)
-
-    # Calculate population-based metrics
-    d['effective_splits'] = calculate_metric(df, lclty_col, pop_col, effective_splits, None)
-    d['conditional_entropy'] = calculate_metric(df, lclty_col, pop_col, conditional_entropy, 1)
-    d['sqrt_entropy'] = calculate_metric(df, lclty_col, pop_col, sqrt_entropy, 1)
-    d['split_pairs'] = calculate_metric(df, lclty_col, pop_col, split_pairs, 1)
-
-    # Calculate geography-based metrics, symmetric version
-    splits_pop_score = d['splits_pop']
-    splits_pop_reversed = calculate_metric(df, plan_col, pop_col, localities_split, None)
-    d['splits_pop_sym'] = (splits_pop_score + splits_pop_reversed) / 2
-    intersections_pop_score = d['intersections_pop']
-    intersections_pop_reversed = calculate_metric(df, plan_col, pop_col, locality_intersections, None)
-    d['intersections_pop_sym'] = (intersections_pop_score + intersections_pop_reversed) / 2
-
-    # Calculate population-based metrics, symmetric version
-    effective_splits_score = d['effective_splits']
-    effective_splits_reversed = calculate_metric(df, plan_col, pop_col, effective_splits, 1)
-    d['effective_splits_sym'] = (effective_splits_score + effective_splits_reversed) / 2
-    conditional_entropy_score = d['conditional_entropy']
-    conditional_entropy_reversed = calculate_metric(df, plan_col, pop_col, conditional_entropy, 1)
-    d['conditional_entropy_sym'] = (conditional_entropy_score + conditional_entropy_reversed) / 2
-    sqrt_entropy_score = d['sqrt_entropy']
-    sqrt_entropy_reversed = calculate_metric(df, plan_col, pop_col, sqrt_entropy, 1)
-    d['sqrt_entropy_sym'] = (sqrt_entropy_score + sqrt_entropy_reversed) / 2
-    split_pairs_score = d['split_pairs']
-    split_pairs_reversed = calculate_metric(df, plan_col, pop_col, split_pairs, 1)
-    d['split_pairs_sym'] = (split_pairs_score + split_pairs_reversed) / 2
+    with _phase('calculate_all_metrics'):
+
+        # get populations of each (locality, district) pair, for every weight at once if there are several
+        weighted = not isinstance(pop_col, str) and pd.api.types.is_list_like(pop_col)
+        tables = Contingency.from_dataframe(df, plan_col, lclty_col=lclty_col,
+                                            pop_col=list(pop_col) if weighted else pop_col)
+
+        scores = {}
+        for weight_col, table in zip(pop_col, tables) if weighted else [(pop_col, tables)]:
+
+            # Initialize dictionary with state and plan names
+            d = {}
+
+            if state is not None:
+                d['state'] = state
+            d['plan'] = plan_col
+
+            # calculate every metric and its symmetric version from the intersection table
+            d.update(table.metrics(metrics, cache))
+            scores[weight_col] = d
+
+    return scores if weighted else scores[pop_col]
+
+
+def calculate_array_metrics(pops, lclty, assignment, metrics=None, cache=None):
+    """Calculate all metrics from the columns of a block table, without a DataFrame.
+
+    Numeric columns are used without copying, and integer, pandas categorical and
+    pyarrow dictionary-encoded localities and districts are coded without converting
+    them to strings.
+
+    Arguments:
+        pops: population of every block (numpy array, pandas Series or pyarrow array)
+        lclty: locality of every block
+        assignment: district of every block
+        metrics: names of the metrics to calculate, see calculate_all_metrics
+        cache: MetricsCache to reuse the metrics of tables scored before
+
+    Output:
+        dictionary of metric scores, keyed like the output of calculate_all_metrics
+    """
+
+    with _phase('calculate_array_metrics'):
+        return Contingency.from_arrays(pops, lclty, assignment).metrics(metrics, cache)
+
+
+def compress_blocks(df, cols, pop_cols='pop'):
+    """Collapse the blocks of a classifications table into atoms: the distinct combinations of locality
+    and districts (e.g. county, cd_2003, cd_2013, ...) with the populations of their blocks added up.
+
+    The metrics only depend on the population of every combination, so the atoms can be scored in
+    place of the blocks by calculate_all_metrics and the other entry points, giving the same results
+    (up to rounding of non-integer populations). Atoms without population are kept, since they
+    count for splits_all and intersections_all, and missing values stay missing.
+
+    Arguments:
+        df: pandas DataFrame with a row for every block
+        cols: names of the locality and district columns to keep
+        pop_cols: name of population column, or list of names
+
+    Output:
+        pandas DataFrame with a row for every atom, sorted by the columns, with the columns, the
+        population columns, and the number of blocks in each atom ('n_blocks')
+    """
+
+    cols = list(cols)
+    pop_cols = [pop_cols] if isinstance(pop_cols, str) else list(pop_cols)
+
+    # give every combination of the columns a single integer key, with room for missing values
+    keys = np.zeros(len(df), dtype=np.int64)
+    n_keys = 1
+    for col in cols:
+        codes, labels = _factorize(df[col])
+
+        # renumber the keys so far if adding the column could overflow them
+        if n_keys * (len(labels) + 1) >= 1 << 62:
+            keys, unique_keys = _factorize(keys)
+            n_keys = len(unique_keys)
+        keys = keys * (len(labels) + 1) + (codes + 1)
+        n_keys *= len(labels) + 1
+
+    # find the atom of every block, and the first block of every atom
+    _, first, atoms = np.unique(keys, return_index=True, return_inverse=True)
+    n_atoms = len(first)
+
+    # keep the columns of the first block of every atom, and add up the populations
+    compressed = df[cols].iloc[first].reset_index(drop=True)
+    for pop_col in pop_cols:
+        pops = _column_array(df[pop_col])
+        sums = np.bincount(atoms, weights=np.nan_to_num(pops) if pops.dtype.kind == 'f' else pops,
+                           minlength=n_atoms)
+        compressed[pop_col] = sums.astype(pops.dtype) if pops.dtype.kind in 'iub' else sums
+    compressed['n_blocks'] = np.bincount(atoms, minlength=n_atoms)
+
+    return compressed
+
+
+def calculate_fractional_metrics(df, assignments, plan_col, unit_col='GEOID10', lclty_col='COUNTYFP10',
+                                 pop_col='pop', weight_col='weight', state=None, metrics=None):
+    """Calculate all metrics for a plan whose units (e.g. precincts) can be split across districts.
+
+    Every unit contributes its population times the weight of each of its districts, e.g. the share of
+    its area or its blocks' population in each, without going down to blocks. See
+    Contingency.from_fractional.
+
+    Arguments:
+        df: pandas DataFrame with a row for every unit, with its label, locality and population
+        assignments: pandas DataFrame with a row for every (unit, district, weight) triple
+        plan_col: name of district column in assignments
+        unit_col: name of unit label column in both DataFrames
+        lclty_col: name of locality column in df
+        pop_col: name of population column in df
+        weight_col: name of weight column in assignments
+        state: state name to include in the output
+        metrics: names of the metrics to calculate, see calculate_all_metrics
+
+    Output:
+        dictionary of metric scores, keyed like the output of calculate_all_metrics
+    """
+
+    with _phase('calculate_fractional_metrics'):
+        table = Contingency.from_fractional(df[pop_col], df[lclty_col], df[unit_col], assignments[unit_col],
+                                            assignments[plan_col], assignments[weight_col])
+
+        # Initialize dictionary with state and plan names
+        d = {}
+
+        if state is not None:
+            d['state'] = state
+        d['plan'] = plan_col
+
+        d.update(table.metrics(metrics))
 
     return d
 
 
+def calculate_layer_metrics(df, plan_col, lclty_cols, pop_col='pop', metrics=None):
+    """Calculate all metrics of a plan for several locality layers (e.g. counties and places) at once.
+
+    The districts are coded once for all layers, and a layer nested inside another one (e.g. counties
+    containing county subdivisions) gets its intersections from those of the finer layer rather than
+    from the blocks.
+
+    Arguments:
+        df: pandas DataFrame with a row for every block
+        plan_col: name of district column
+        lclty_cols: names of the locality columns, one per layer
+        pop_col: name of population column
+        metrics: names of the metrics to calculate, see calculate_all_metrics
+
+    Output:
+        pandas DataFrame indexed by (layer, metric) with the score of every metric for every layer in a
+        'score' column
+    """
+
+    # get integer codes for the districts once, and for the localities of each layer
+    plan_codes, plan_labels = _factorize(df[plan_col])
+    pops = df[pop_col].to_numpy()
+    layers = {col: _factorize(df[col]) for col in lclty_cols}
+
+    # build the tables from the finest layer to the coarsest
+    tables = {}
+    for col in sorted(layers, key=lambda col: -len(layers[col][1])):
+        lclty_codes, lclty_labels = layers[col]
+
+        # look for the coarsest finer layer this one is nested in
+        for finer in reversed(tables):
+            fine_codes = layers[finer][0]
+            row_map = np.full(len(layers[finer][1]), -1)
+            row_map[fine_codes[fine_codes >= 0]] = lclty_codes[fine_codes >= 0]
+            if (np.where(fine_codes >= 0, row_map[fine_codes], -1) == lclty_codes).all():
+                break
+        else:
+            finer = None
+
+        # sum the intersections of the finer layer by locality of this one, or else sum the blocks
+        if finer is not None:
+            fine = tables[finer]
+            rows, cols, table_pops = _intersection_table(row_map[fine.rows], fine.indices, fine.data,
+                                                         len(lclty_labels), len(plan_labels))
+        else:
+            rows, cols, table_pops = _intersection_table(lclty_codes, plan_codes, pops,
+                                                         len(lclty_labels), len(plan_labels))
+        tables[col] = Contingency(_indptr(rows, len(lclty_labels)), cols, table_pops, lclty_labels,
+                                  plan_labels)
+
+    # put together the tidy table of scores, in the order the layers were given
+    scores = [(col, metric, score) for col in lclty_cols for metric, score in tables[col].metrics(metrics).items()]
+    return pd.DataFrame(scores, columns=['layer', 'metric', 'score']).set_index(['layer', 'metric'])
+
+
+def calculate_plan_similarity(df, plan_cols, pop_col='pop'):
+    """Compare every pair of plans (e.g. cd_2003 and cd_2013), treating one plan as the localities of
+    the other.
+
+    Every plan column is coded once, and each plan is compared to all plans at once by stacking them
+    in a single intersection table, as calculate_ensemble_metrics does. Only the metrics below get
+    calculated.
+
+        conditional_entropy: conditional_entropy of the column plan within the districts of the row
+            plan, i.e. H(column | row) in bits
+        variation_of_information: H(column | row) + H(row | column), a distance between the plans
+        split_pairs: split_pairs of the column plan within the districts of the row plan
+
+    Arguments:
+        df: pandas DataFrame with a row for every block
+        plan_cols: list of names of district columns
+        pop_col: name of population column
+
+    Output:
+        dictionary with a pandas DataFrame for each metric, with a row and a column for every plan
+    """
+
+    plan_cols = list(plan_cols)
+    pops = df[pop_col].to_numpy()
+
+    # get integer codes for the districts of every plan
+    with _phase('factorize'):
+        plan_codes = []
+        n_districts = 0
+        for plan_col in plan_cols:
+            codes, labels = _factorize(df[plan_col])
+            plan_codes.append(codes)
+            n_districts = max(n_districts, len(labels))
+        plan_codes = np.vstack(plan_codes) if plan_codes else np.empty((0, len(pops)), dtype=np.int64)
+
+    # score all plans within the districts of each plan at once
+    scores = {'conditional_entropy': [], 'split_pairs': []}
+    for lclty_codes in plan_codes:
+        chunk = _score_ensemble_chunk(pops, lclty_codes, n_districts, plan_codes, n_districts,
+                                      metrics=list(scores))
+        for metric in scores:
+            scores[metric].append(chunk[metric])
+
+    # the variation of information adds up the conditional entropies both ways
+    entropies = np.array(scores['conditional_entropy']).reshape(len(plan_cols), len(plan_cols))
+    scores['variation_of_information'] = entropies + entropies.T
+
+    index = pd.Index(plan_cols)
+    return {metric: pd.DataFrame(np.array(scores[metric]).reshape(len(index), len(index)), index=index,
+                                 columns=index)
+            for metric in ['conditional_entropy', 'variation_of_information', 'split_pairs']}
+
+
+def calculate_metric_breakdown(df, plan_col, lclty_col='COUNTYFP10', pop_col='pop', metrics=None):
+    """Calculate the contribution of every locality to every metric, e.g. to find which counties drive
+    split_pairs or effective_splits.
+
+    Symmetric metrics also get the contribution of every district, from their side with districts
+    treated as localities. The contributions of a metric add up to its score in calculate_all_metrics
+    (up to rounding), and the table is calculated from the same scores, so calling metrics() on the
+    same Contingency afterwards (see Contingency.explain) costs nothing extra.
+
+    Arguments:
+        df: pandas DataFrame with a row for every block
+        plan_col: name of district column
+        lclty_col: name of locality column
+        pop_col: name of population column
+        metrics: names of the metrics to break down, see calculate_all_metrics
+
+    Output:
+        pandas DataFrame with a row for every (metric, side, locality or district) with columns
+            metric: name of the metric
+            side: 'locality', or 'district' for the side of a symmetric metric with districts as localities
+            unit: label of the locality or district
+            pop: its population
+            score: its score
+            weight: the weight of its score in the metric (1 if scores are just added up)
+            contribution: weight * score (halved for symmetric metrics, which average both sides)
+    """
+
+    table = Contingency.from_dataframe(df, plan_col, lclty_col=lclty_col, pop_col=pop_col)
+    return table.explain(metrics)
+
+
+def calculate_exponent_sweep(df, plan_col, agg_exponents, lclty_col='COUNTYFP10', pop_col='pop', metrics=None):
+    """Calculate all metrics of a plan with many different aggregation exponents.
+
+    The score and population of every locality are calculated once, and then aggregated with weights
+    proportional to population ^ agg_exponent (see calculate_metric) for every exponent at once.
+    Every metric gets aggregated with every exponent, including those normally just added up, and both
+    sides of symmetric metrics get the same exponent.
+
+    Arguments:
+        df: pandas DataFrame with a row for every block
+        plan_col: name of district column
+        agg_exponents: list of aggregation exponents, where None just adds up the scores
+        lclty_col: name of locality column
+        pop_col: name of population column
+        metrics: names of the metrics to calculate, see calculate_all_metrics
+
+    Output:
+        pandas DataFrame with a row for every metric and a column for every exponent
+    """
+
+    table = Contingency.from_dataframe(df, plan_col, lclty_col=lclty_col, pop_col=pop_col)
+    return table.sweep(agg_exponents, metrics)
+
+
+def calculate_diversity_metrics(df, plan_col, orders, index='hill', lclty_col='COUNTYFP10', pop_col='pop',
+                                agg_exponent=1):
+    """Calculate a generalized diversity index of how each locality is split, for many orders at once.
+
+    For the proportions p of a locality's population in each district, the indices of order q are
+
+        hill: effective number of districts, (sum of p ^ q) ^ (1 / (1 - q)), or 2 ^ entropy for q = 1
+        renyi: log2 of the Hill number, in bits
+        tsallis: (1 - sum of p ^ q) / (q - 1), or the entropy in nats for q = 1
+
+    conditional_entropy is the Renyi index of order 1, sqrt_entropy is the square root of the Hill
+    index of order 1/2 and effective_splits is the Hill index of order 2 minus 1, calculated exactly as
+    those metrics are. Every order is calculated in one pass over the intersections.
+
+    Arguments:
+        df: pandas DataFrame with a row for every block
+        plan_col: name of district column
+        orders: list of orders q (at least zero)
+        index: 'hill', 'renyi' or 'tsallis'
+        lclty_col: name of locality column
+        pop_col: name of population column
+        agg_exponent: how to aggregate scores across localities, see calculate_metric
+
+    Output:
+        pandas DataFrame with a row for every order, with the index ('diversity') and its symmetric
+        version ('diversity_sym')
+    """
+
+    table = Contingency.from_dataframe(df, plan_col, lclty_col=lclty_col, pop_col=pop_col)
+    return table.diversity(orders, index, agg_exponent)
+
+
+def calculate_ensemble_metrics(pops, lclty, assignments, plans=None, chunk_size=None, processes=None,
+                               metrics=None):
+    """Calculate all metrics for every plan in an ensemble drawn on the same blocks.
+
+    Arguments:
+        pops: population of every block
+        lclty: locality of every block (codes or labels)
+        assignments: (n_plans x n_blocks) array with the district of every block in every plan. An
+            np.memmap (a whole one, not a slice of one) gets read straight from its file by every process.
+        plans: names of the plans, used to index the output (defaults to 0, ..., n_plans - 1)
+        chunk_size: number of plans to score together, which bounds memory use (by default enough
+            plans to cover a few million blocks)
+        processes: number of worker processes to score chunks of plans in parallel (by default the
+            plans are scored in this process). Block populations, localities and assignments are put
+            in shared memory once, so workers only receive the range of plans to score.
+        metrics: names of the metrics to calculate, see calculate_all_metrics
+
+    Output:
+        pandas DataFrame with a row for every plan and a column for every metric returned by
+        calculate_all_metrics
+    """
+
+    # factorize the localities once for the whole ensemble
+    lclty_codes, lclty_labels = _factorize(lclty)
+    pops = np.asarray(pops)
+    if not isinstance(assignments, np.memmap):
+        assignments = np.asarray(assignments)
+    if assignments.ndim != 2 or assignments.shape[1] != len(pops):
+        raise ValueError("assignments must be an (n_plans x n_blocks) array")
+    n_lcltys = len(lclty_labels)
+
+    # factorize districts that aren't integers once for the whole ensemble
+    n_districts = None
+    if assignments.dtype.kind not in 'iub':
+        codes, district_labels = _factorize(assignments.ravel())
+        assignments = codes.reshape(assignments.shape)
+        n_districts = len(district_labels)
+
+    # split the plans into chunks
+    if chunk_size is None:
+        chunk_size = max(1, (1 << 22) // max(len(pops), 1))
+    bounds = [(start, min(start + chunk_size, len(assignments)))
+              for start in range(0, len(assignments), chunk_size)]
+
+    # score the chunks here, or in a pool of processes sharing the block arrays
+    if processes is None or processes <= 1:
+        chunks = [_score_ensemble_chunk(pops, lclty_codes, n_lcltys, assignments[start:stop], n_districts,
+                                        metrics)
+                  for start, stop in bounds]
+    else:
+        chunks = _score_ensemble_parallel(pops, lclty_codes, n_lcltys, assignments, n_districts, bounds,
+                                          processes, metrics)
+
+    # put together the table of scores
+    df = pd.concat([pd.DataFrame(chunk) for chunk in chunks], ignore_index=True) if chunks else pd.DataFrame()
+    df.index = pd.Index(range(len(df)) if plans is None else plans, name='plan')
+
+    return df
+
+
+def _score_ensemble_chunk(pops, lclty_codes, n_lcltys, chunk, n_districts=None, metrics=None):
+    """Scores a chunk of plans for calculate_ensemble_metrics, returning a dictionary with an array of
+    scores for each metric. If n_districts is given, the chunk already holds district codes (-1 for
+    missing) rather than labels."""
+
+    n_batch = len(chunk)
+
+    # get integer codes for the districts of every plan in the chunk
+    if n_districts is None:
+        plan_codes, n_districts = _district_codes(np.asarray(chunk))
+    else:
+        plan_codes = np.asarray(chunk)
+
+    # give every (plan, locality) pair its own locality code, keeping blocks without a locality out
+    batch_codes = np.where(lclty_codes >= 0, np.arange(n_batch)[:, None] * n_lcltys + lclty_codes, -1)
+
+    # sum populations of all intersections
+    rows, cols, intersection_pops = _intersection_table(batch_codes.ravel(), plan_codes.ravel(),
+                                                        np.tile(pops, n_batch), n_batch * n_lcltys,
+                                                        n_districts)
+
+    return _score_table(rows, cols, intersection_pops, n_lcltys, n_districts, n_batch=n_batch, metrics=metrics)
+
+
+# block arrays attached by each worker process of _score_ensemble_parallel
+_SHARED = {}
+
+
+def _score_ensemble_parallel(pops, lclty_codes, n_lcltys, assignments, n_districts, bounds, processes,
+                             metrics):
+    """Scores chunks of plans in a pool of processes, with the block arrays in shared memory.
+
+    Output:
+        list of the outputs of _score_ensemble_chunk, in the order of bounds
+    """
+
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import shared_memory
+
+    blocks = []
+    try:
+
+        # copy each array into shared memory, unless it already lives in a file every process can map (only
+        # whole memmaps, since views of one keep the offset of the whole map)
+        specs = {}
+        for name, array in [('pops', pops), ('lclty_codes', lclty_codes), ('assignments', assignments)]:
+            if (isinstance(array, np.memmap) and isinstance(array.base, mmap.mmap) and array.filename is not None
+                    and array.flags.c_contiguous):
+                specs[name] = ('memmap', array.filename, array.dtype.str, array.shape, array.offset)
+            else:
+                block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                blocks.append(block)
+                np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+                specs[name] = ('shm', block.name, array.dtype.str, array.shape, 0)
+
+        # hand out ranges of plans to the workers and gather their scores in order
+        with ProcessPoolExecutor(max_workers=processes, initializer=_attach_shared,
+                                 initargs=(specs, n_lcltys, n_districts, metrics)) as pool:
+            return list(pool.map(_score_shared_chunk, bounds))
+
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+
+def _attach_shared(specs, n_lcltys, n_districts, metrics):
+    """Initializes a worker process of _score_ensemble_parallel by mapping the shared block arrays."""
+
+    from multiprocessing import shared_memory
+
+    for name, (kind, location, dtype, shape, offset) in specs.items():
+        if kind == 'memmap':
+            _SHARED[name] = np.memmap(location, dtype=dtype, mode='r', shape=shape, offset=offset)
+        else:
+            block = shared_memory.SharedMemory(name=location)
+            _SHARED[name + '_block'] = block
+            _SHARED[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    _SHARED['n_lcltys'] = n_lcltys
+    _SHARED['n_districts'] = n_districts
+    _SHARED['metrics'] = metrics
+
+
+def _score_shared_chunk(bounds):
+    """Scores the plans in range(*bounds) in a worker process of _score_ensemble_parallel."""
+
+    start, stop = bounds
+    return _score_ensemble_chunk(_SHARED['pops'], _SHARED['lclty_codes'], _SHARED['n_lcltys'],
+                                 _SHARED['assignments'][start:stop], _SHARED['n_districts'], _SHARED['metrics'])
+
+
+def calculate_streaming_metrics(paths, plan_cols, lclty_col='COUNTYFP10', pop_col='pop', by_file=False,
+                                chunksize=1000000, metrics=None):
+    """Calculate all metrics for many plans from block files too big to load at once.
+
+    Blocks are read a chunk at a time and only the population of every (locality, district) pair of
+    every plan is kept, so memory use is bounded by the size of those tables rather than by the
+    number of blocks.
+
+    Arguments:
+        paths: path (or list of paths) of CSV or Parquet files with a row for every block
+        plan_cols: names of the district columns of the plans to score
+        lclty_col: name of the locality column, or a function taking a chunk of blocks (DataFrame) and
+            returning the locality of each, e.g. lambda df: df['GEOID10'].str[:5] for counties
+        pop_col: name of population column
+        by_file: whether to score each file separately (e.g. one classifications file per state) rather
+            than all files as one table. Files are allowed to lack some of the plans. When scoring them as
+            one table, localities and districts with the same label in different files are the same.
+        chunksize: number of blocks to read at a time
+        metrics: names of the metrics to calculate, see calculate_all_metrics
+
+    Output:
+        pandas DataFrame with a row for every plan (or every (file, plan) pair if by_file) and a column
+        for every metric returned by calculate_all_metrics
+    """
+
+    if isinstance(paths, str):
+        paths = [paths]
+    plan_cols = list(plan_cols)
+
+    rows = []
+    index = []
+    partials = {}
+    for i, path in enumerate(paths):
+
+        # read only the columns we need, unless the locality gets derived from other columns
+        file_plan_cols = [col for col in plan_cols if col in _file_columns(path)]
+        usecols = None if callable(lclty_col) else [lclty_col] + file_plan_cols + [pop_col]
+
+        for chunk in _read_chunks(path, usecols, pop_col, chunksize):
+
+            # add up the population of every (locality, district) pair of every plan in the chunk
+            lclty = lclty_col(chunk) if callable(lclty_col) else chunk[lclty_col]
+            for plan_col in file_plan_cols:
+                pairs = chunk[pop_col].groupby([lclty, chunk[plan_col]], sort=False).sum()
+                partials.setdefault(plan_col, []).append(pairs)
+
+                # merge the partial sums every so often to bound memory
+                if len(partials[plan_col]) >= 16:
+                    partials[plan_col] = [_merge_pair_sums(partials[plan_col])]
+
+        # score the plans once their last file is read
+        if by_file or i == len(paths) - 1:
+            for plan_col in [col for col in plan_cols if col in partials]:
+                pairs = _merge_pair_sums(partials.pop(plan_col))
+                table = Contingency.from_arrays(pairs.to_numpy(), pairs.index.get_level_values(0),
+                                                pairs.index.get_level_values(1))
+                rows.append(table.metrics(metrics))
+                index.append((path, plan_col) if by_file else plan_col)
+
+    names = ['file', 'plan'] if by_file else 'plan'
+    return pd.DataFrame(rows, index=pd.MultiIndex.from_tuples(index, names=names) if by_file
+                        else pd.Index(index, name=names))
+
+
+class Contingency:
+    """Sparse table of the population of every (locality, district) intersection of a plan.
+
+    The table is stored in compressed sparse row (CSR) form, one row per locality, with an explicit
+    entry for every intersection that contains at least one block (even with zero population). The
+    transpose, with one row per district, is cached, so every metric can be scored in both
+    orientations without regrouping blocks, and per-locality scores are cached for rescoring.
+
+    Arguments:
+        indptr: row i has its entries in positions indptr[i] through indptr[i + 1] - 1
+        indices: column (district) code of each entry, sorted within each row
+        data: population of each entry
+        row_labels: label of each row (locality)
+        col_labels: label of each column (district)
+    """
+
+    def __init__(self, indptr, indices, data, row_labels, col_labels):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.data = np.asarray(data, dtype=float)
+        self.row_labels = row_labels
+        self.col_labels = col_labels
+        self._transpose = None
+        self._segments = {}
+        self._fingerprint = None
+
+    def __getstate__(self):
+        # leave the cached transpose and scores out when pickling
+        state = self.__dict__.copy()
+        state['_transpose'] = None
+        state['_segments'] = {}
+        return state
+
+    def fingerprint(self):
+        """Returns a hash of the contents of the table (not its labels), identifying it for MetricsCache."""
+
+        if self._fingerprint is None:
+            digest = hashlib.blake2b(digest_size=16)
+            digest.update(np.array(self.shape, dtype=np.int64).tobytes())
+            for array in [self.indptr, self.indices, self.data]:
+                digest.update(np.ascontiguousarray(array).tobytes())
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    @classmethod
+    def from_dataframe(cls, df, plan_col, lclty_col='COUNTYFP10', pop_col='pop'):
+        """Builds the table from a DataFrame with a row for every block, see calculate_all_metrics.
+        A list of population columns gives a list of tables, see from_arrays."""
+
+        if isinstance(pop_col, list):
+            pops = np.column_stack([_column_array(df[col]) for col in pop_col])
+        else:
+            pops = _column_array(df[pop_col])
+        return cls.from_arrays(pops, df[lclty_col], df[plan_col])
+
+    @classmethod
+    def from_arrays(cls, pops, lclty, assignment):
+        """Builds the table from the population, locality and district of every block. Localities and
+        districts may be numpy arrays, pandas Series (including categoricals) or pyarrow arrays (including
+        dictionary-encoded ones), and get coded without converting them to strings or objects.
+
+        When pops is a 2-D array with a column for each of several population weights (e.g. total
+        population, voting age population and citizen voting age population), returns a list with a
+        table for each weight, all summed over the blocks at once and sharing their intersections.
+        """
+
+        # get integer codes for each locality and district
+        with _phase('factorize'):
+            lclty_codes, lclty_labels = _factorize(lclty)
+            plan_codes, plan_labels = _factorize(assignment)
+
+        # get populations of each (locality, district) pair, sorted by locality then district
+        with _phase('intersections'):
+            rows, cols, pops = _intersection_table(lclty_codes, plan_codes, _column_array(pops),
+                                                   len(lclty_labels), len(plan_labels))
+
+        indptr = _indptr(rows, len(lclty_labels))
+        if pops.ndim == 2:
+            return [cls(indptr, cols, weight, lclty_labels, plan_labels) for weight in pops.T]
+        return cls(indptr, cols, pops, lclty_labels, plan_labels)
+
+    @classmethod
+    def from_fractional(cls, pops, lclty, units, assigned_units, districts, weights):
+        """Builds the table from units (e.g. precincts) split across districts with fractional weights.
+
+        Every (unit, district, weight) triple puts weight times the unit's population into the unit's
+        locality and the district. Triples with positive weight count as intersections even for units
+        without population, like blocks do; the others are left out. Weights of a unit are expected to
+        add up to 1, but aren't checked.
+
+        Arguments:
+            pops: population of every unit
+            lclty: locality of every unit
+            units: label of every unit
+            assigned_units: unit label of every triple
+            districts: district of every triple
+            weights: weight of every triple
+        """
+
+        # find the position of the unit of every triple
+        units = pd.Index(units)
+        if not units.is_unique:
+            raise ValueError('Unit labels must be unique')
+        positions = units.get_indexer(assigned_units)
+        if (positions < 0).any():
+            raise ValueError(f'Unknown units: {list(pd.unique(np.asarray(assigned_units)[positions < 0])[:10])}')
+
+        # keep the triples with positive weight
+        weights = _column_array(weights).astype(float)
+        keep = weights > 0
+        positions, weights = positions[keep], weights[keep]
+        districts = _column_array(districts)[keep]
+
+        # get integer codes for each locality and district, with every unit's locality for its triples
+        with _phase('factorize'):
+            lclty_codes, lclty_labels = _factorize(lclty)
+            plan_codes, plan_labels = _factorize(districts)
+
+        # get weighted populations of each (locality, district) pair
+        with _phase('intersections'):
+            weighted_pops = _column_array(pops)[positions] * weights
+            rows, cols, weighted_pops = _intersection_table(lclty_codes[positions], plan_codes, weighted_pops,
+                                                            len(lclty_labels), len(plan_labels))
+
+        return cls(_indptr(rows, len(lclty_labels)), cols, weighted_pops, lclty_labels, plan_labels)
+
+    @classmethod
+    def load(cls, path):
+        """Reads a table written by save()."""
+
+        with np.load(path, allow_pickle=False) as f:
+            return cls(f['indptr'], f['indices'], f['data'], pd.Index(f['row_labels']),
+                       pd.Index(f['col_labels']))
+
+    def save(self, path):
+        """Writes the table to a compressed .npz file. Labels that are not numbers are stored as strings."""
+
+        np.savez_compressed(path, indptr=self.indptr, indices=self.indices, data=self.data,
+                            row_labels=_label_array(self.row_labels), col_labels=_label_array(self.col_labels))
+
+    @property
+    def shape(self):
+        """(number of localities, number of districts)"""
+        return len(self.row_labels), len(self.col_labels)
+
+    @property
+    def nnz(self):
+        """Number of intersections stored."""
+        return len(self.data)
+
+    @property
+    def rows(self):
+        """Row (locality) code of each entry."""
+        return np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+
+    @property
+    def row_totals(self):
+        """Population of every row (locality)."""
+        return self.segments(populated=False).totals
+
+    @property
+    def col_totals(self):
+        """Population of every column (district)."""
+        return self.T.row_totals
+
+    @property
+    def T(self):
+        """The transposed table, with a row for every district (compressed sparse column form of this one)."""
+
+        if self._transpose is None:
+
+            # stably sort the entries by column, keeping them sorted by row within each column
+            with _phase('transpose'):
+                order = np.argsort(self.indices, kind='stable')
+                indptr = _indptr(self.indices[order], self.shape[1])
+                self._transpose = Contingency(indptr, self.rows[order], self.data[order],
+                                              self.col_labels, self.row_labels)
+                self._transpose._transpose = self
+
+        return self._transpose
+
+    def transpose(self):
+        """Returns the transposed table, see T."""
+        return self.T
+
+    def segments(self, populated=True):
+        """Returns the (cached) _Segments of the entries grouped by row."""
+
+        if populated not in self._segments:
+            with _phase('segments'):
+                self._segments[populated] = _Segments(self.rows, self.data, self.shape[0], populated=populated)
+        return self._segments[populated]
+
+    def score(self, metric_function, agg_exponent, populated=True):
+        """Calculates a locality splitting score with each row treated as a locality, see calculate_metric.
+        Score the transpose (T) to treat districts as localities instead.
+
+        Arguments:
+            metric_function: one of the metric functions defined below, or another function scoring a
+                single locality from its intersection populations (which gets called once per locality)
+            agg_exponent: see calculate_metric
+            populated: whether to ignore intersections with zero population
+
+        Output:
+            numeric of splitting metric score
+        """
+
+        return self.segments(populated).metric(_kernel(metric_function), agg_exponent)[0]
+
+    def metrics(self, metrics=None, cache=None):
+        """Returns a dictionary of all metrics (or those named in metrics), keyed like calculate_all_metrics.
+        Looks them up in a MetricsCache first if one is given."""
+
+        if cache is not None:
+            return cache.metrics(self, metrics)
+
+        d = _assemble_metrics(lambda reverse, populated: (self.T if reverse else self).segments(populated),
+                              metrics)
+        return {metric: scores[0] for metric, scores in d.items()}
+
+    def explain(self, metrics=None):
+        """Returns the contribution of every locality (and district) to every metric, see
+        calculate_metric_breakdown. Shares the cached scores with metrics()."""
+
+        names = _metric_names(metrics)
+        parts = []
+        for definition in METRICS.values():
+            for name, reverse, agg_exponent in [(definition.name, False, definition.agg_exponent),
+                                                (definition.name + '_sym', False, definition.agg_exponent),
+                                                (definition.name + '_sym', True, definition.sym_agg_exponent)]:
+                if name not in names:
+                    continue
+
+                # get the score and weight of every locality (or district) with intersections
+                table = self.T if reverse else self
+                ids, pops, scores, weights = table.segments(definition.populated).explain(definition.kernel,
+                                                                                          agg_exponent)
+
+                # symmetric metrics average both sides
+                share = 0.5 if name.endswith('_sym') else 1.0
+                parts.append(pd.DataFrame({'metric': name, 'side': 'district' if reverse else 'locality',
+                                           'unit': np.asarray(table.row_labels)[ids], 'pop': pops,
+                                           'score': scores.astype(float), 'weight': weights,
+                                           'contribution': weights * scores * share}))
+
+        # order the rows like the metrics, and store repeated names as categoricals
+        df = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(
+            columns=['metric', 'side', 'unit', 'pop', 'score', 'weight', 'contribution'])
+        order = [name for name in names if name in set(df['metric'])]
+        df['metric'] = pd.Categorical(df['metric'], categories=order)
+        df['side'] = pd.Categorical(df['side'], categories=['locality', 'district'])
+        return df.sort_values(['metric', 'side'], kind='stable', ignore_index=True)
+
+    def sweep(self, agg_exponents, metrics=None):
+        """Returns a DataFrame with a row for every metric (or those named in metrics) and a column for
+        every aggregation exponent, see calculate_exponent_sweep."""
+
+        d = _assemble_sweep(lambda reverse, populated: (self.T if reverse else self).segments(populated),
+                            list(agg_exponents), metrics)
+        return pd.DataFrame({metric: scores[:, 0] for metric, scores in d.items()},
+                            index=pd.Index(list(agg_exponents), dtype=object, name='agg_exponent')).T
+
+    def diversity(self, orders, index='hill', agg_exponent=1):
+        """Returns a DataFrame with the diversity index of every order, see calculate_diversity_metrics."""
+
+        orders = list(orders)
+        scores = {'diversity': self.segments(True).diversity(orders, index, agg_exponent)[:, 0],
+                  'diversity_sym': self.T.segments(True).diversity(orders, index, agg_exponent)[:, 0]}
+        scores['diversity_sym'] = (scores['diversity'] + scores['diversity_sym']) / 2
+        return pd.DataFrame(scores, index=pd.Index(orders, name='order'))
+
+    def to_dataframe(self, lclty_col='locality', plan_col='district', pop_col='pop'):
+        """Returns the table as a DataFrame with a row for every (locality, district) intersection."""
+
+        return pd.DataFrame({lclty_col: np.asarray(self.row_labels)[self.rows],
+                             plan_col: np.asarray(self.col_labels)[self.indices],
+                             pop_col: self.data})
+
+    def to_scipy(self):
+        """Returns the table as a scipy.sparse.csr_matrix (requires scipy)."""
+
+        from scipy import sparse
+        return sparse.csr_matrix((self.data, self.indices, self.indptr), shape=self.shape)
+
+
+class IncrementalScorer:
+    """Keeps all metrics of a plan up to date as blocks move between districts, e.g. in a Markov chain.
+
+    The scorer holds the population, block count and populated block count of every (locality, district)
+    pair and the score of every locality and district. Moving blocks only rescores the localities and districts they
+    touch, and scores always match calculate_all_metrics on the current plan.
+
+    Arguments:
+        pops: population of every block
+        lclty: locality of every block (codes or labels)
+        assignment: district of every block
+        districts: every district label blocks may move to (defaults to those in assignment)
+    """
+
+    def __init__(self, pops, lclty, assignment, districts=None):
+
+        # get integer codes for the localities and districts
+        self.lclty_codes, self.lclty_labels = _factorize(lclty)
+        assignment = np.asarray(assignment)
+        if districts is None:
+            districts = assignment
+        _, self.district_labels = _factorize(districts)
+        self._district_lookup = {label: code for code, label in enumerate(self.district_labels)}
+        self.plan_codes = self._district_codes(assignment)
+
+        # keep integer populations as integers so moving blocks back and forth is exact
+        self.pops = np.asarray(pops)
+        if self.pops.dtype.kind != 'f':
+            self.pops = self.pops.astype(np.int64)
+
+        # get the population, block count and populated block count of every (locality, district) pair
+        shape = (len(self.lclty_labels), len(self.district_labels))
+        self._table = np.zeros(shape, dtype=self.pops.dtype)
+        self._blocks = np.zeros(shape, dtype=np.int64)
+        self._populated = np.zeros(shape, dtype=np.int64)
+        self._last_moves = None
+        located = self._located(np.arange(len(self.pops)))
+        rows, cols = self._pairs(located)
+        np.add.at(self._table, (rows, cols), self.pops[located])
+        np.add.at(self._blocks, (rows, cols), 1)
+        np.add.at(self._populated, (rows, cols), self.pops[located] > 0)
+
+        self._score_all()
+
+    def _score_all(self):
+        """Scores every locality and district for every registered metric from the table."""
+
+        # group the intersections by locality and by district, with and without the unpopulated ones
+        rows, cols = np.nonzero(self._blocks)
+        pops = self._table[rows, cols].astype(float)
+        order = np.argsort(cols, kind='stable')
+        self._sides = {}
+        for populated in [False, True]:
+            self._sides[False, populated] = _Segments(rows, pops, self._table.shape[0], populated=populated)
+            self._sides[True, populated] = _Segments(cols[order], pops[order], self._table.shape[1],
+                                                     populated=populated)
+
+        # score every group for every metric, so moves can keep the scores up to date
+        self._kernels = {definition.kernel for definition in METRICS.values()}
+        for side in self._sides.values():
+            for kernel in self._kernels:
+                side.score(kernel)
+
+    @property
+    def assignment(self):
+        """District label of every block in the current plan."""
+        return self.district_labels[self.plan_codes]
+
+    def metrics(self, metrics=None):
+        """Returns a dictionary of all metrics (or those named in metrics) for the current plan, keyed like
+        calculate_all_metrics."""
+
+        # rescore everything if metrics were registered since the scores were calculated
+        if any(definition.kernel not in self._kernels for definition in METRICS.values()):
+            self._score_all()
+
+        d = _assemble_metrics(lambda reverse, populated: self._sides[reverse, populated], metrics)
+        return {metric: scores[0] for metric, scores in d.items()}
+
+    def move(self, moves, metrics=None):
+        """Moves blocks to new districts and returns the updated metrics.
+
+        Arguments:
+            moves: list of (block, new_district) pairs, with blocks given by position and districts by label.
+                If a block appears more than once, its last move wins.
+            metrics: names of the metrics to return, see calculate_all_metrics
+
+        Output:
+            dictionary of all metrics for the new plan, see metrics()
+        """
+
+        # find the last move of each block
+        blocks = np.array([block for block, _ in moves], dtype=np.int64)
+        new_codes = self._district_codes([district for _, district in moves])
+        blocks, last = np.unique(blocks[::-1], return_index=True)
+        new_codes = new_codes[::-1][last]
+
+        # remember the previous districts so the moves can be reverted
+        self._last_moves = (blocks, self.plan_codes[blocks])
+        self._reassign(blocks, new_codes)
+
+        return self.metrics(metrics)
+
+    def revert(self, metrics=None):
+        """Undoes the last call to move() (e.g. a rejected proposal) and returns the restored metrics."""
+
+        if self._last_moves is None:
+            raise ValueError("No moves to revert")
+        blocks, old_codes = self._last_moves
+        self._last_moves = None
+        self._reassign(blocks, old_codes)
+
+        return self.metrics(metrics)
+
+    def _district_codes(self, districts):
+        """Looks up the integer codes of district labels."""
+
+        try:
+            return np.array([self._district_lookup[district] for district in districts], dtype=np.int64)
+        except KeyError as e:
+            raise ValueError(f"Unknown district {e.args[0]!r}") from None
+
+    def _located(self, blocks):
+        """Returns the blocks, out of those given, that have a locality."""
+        return blocks[self.lclty_codes[blocks] >= 0]
+
+    def _pairs(self, blocks):
+        """Returns the (locality, district) codes of the blocks that have a locality."""
+
+        blocks = self._located(blocks)
+        return self.lclty_codes[blocks], self.plan_codes[blocks]
+
+    def _reassign(self, blocks, new_codes):
+        """Moves blocks to the districts with the given codes and rescores what they touch."""
+
+        # take the blocks out of their old intersections
+        old_rows, old_cols = self._pairs(blocks)
+        located = self._located(blocks)
+        np.subtract.at(self._table, (old_rows, old_cols), self.pops[located])
+        np.subtract.at(self._blocks, (old_rows, old_cols), 1)
+        np.subtract.at(self._populated, (old_rows, old_cols), self.pops[located] > 0)
+
+        # put them in their new intersections
+        self.plan_codes[blocks] = new_codes
+        new_rows, new_cols = self._pairs(blocks)
+        np.add.at(self._table, (new_rows, new_cols), self.pops[located])
+        np.add.at(self._blocks, (new_rows, new_cols), 1)
+        np.add.at(self._populated, (new_rows, new_cols), self.pops[located] > 0)
+
+        # float populations leave rounding residue behind, so zero the intersections left unpopulated
+        emptied = self._populated[old_rows, old_cols] == 0
+        self._table[old_rows[emptied], old_cols[emptied]] = 0
+
+        # rescore the touched localities from their rows of the table
+        ids = np.unique(np.concatenate([old_rows, new_rows]))
+        groups, cols = np.nonzero(self._blocks[ids])
+        pops = self._table[ids][groups, cols].astype(float)
+        self._sides[False, False].refresh(ids, groups, pops)
+        self._sides[False, True].refresh(ids, groups, pops)
+
+        # rescore the touched districts from their columns of the table
+        ids = np.unique(np.concatenate([old_cols, new_cols]))
+        groups, rows = np.nonzero(self._blocks[:, ids].T)
+        pops = self._table[:, ids].T[groups, rows].astype(float)
+        self._sides[True, False].refresh(ids, groups, pops)
+        self._sides[True, True].refresh(ids, groups, pops)
+
+
 def calculate_metric(df, lclty_col, pop_col, metric_function, agg_exponent, populated=True):
     """Calculates a locality splitting score for a redistricting plan.
 
@@ -94,11 +1067,17 @@ def calculate_metric(df, lclty_col, pop_col, metric_function, agg_exponent, popu
 
     # if restricting to populated intersections, get rid of the zero-population pairs
     if populated:
-        df = df[df[pop_col] > 0]
+        with _phase('filter'):
+            df = df[df[pop_col] > 0]
+
+    # when profiling, time each call of the metric function
+    if _PROFILE.get() is not None:
+        metric_function = _profiled(metric_function)
 
     # calculate the population of each locality and the splitting metric for each locality
-    lclty_metrics = df.groupby([lclty_col], as_index=False)
-    lclty_metrics = lclty_metrics.agg({pop_col: [sum, metric_function]})
+    with _phase('groupby'):
+        lclty_metrics = df.groupby([lclty_col], as_index=False)
+        lclty_metrics = lclty_metrics.agg({pop_col: [sum, metric_function]})
 
     # grab the columns for the metric and the locality population
     metric_col = lclty_metrics.columns[-1]
@@ -112,14 +1091,329 @@ def calculate_metric(df, lclty_col, pop_col, metric_function, agg_exponent, popu
         lclty_metrics[lclty_pop_col] = lclty_metrics[lclty_pop_col] ** agg_exponent
         lclty_metrics[lclty_pop_col] = lclty_metrics[lclty_pop_col] / lclty_metrics[lclty_pop_col].sum()
 
-        # get a weighted score across all localities
-        score = (lclty_metrics[lclty_pop_col] * lclty_metrics[metric_col]).sum()
+        # get a weighted score across all localities
+        score = (lclty_metrics[lclty_pop_col] * lclty_metrics[metric_col]).sum()
+
+    # otherwise just add up the scores
+    else:
+        score = lclty_metrics[metric_col].sum()
+
+    return score
+
+
+# definition of a metric calculated by calculate_all_metrics, see register_metric
+MetricDefinition = collections.namedtuple('MetricDefinition', ['name', 'kernel', 'agg_exponent', 'populated',
+                                                               'symmetric', 'sym_agg_exponent'])
+
+# registered metrics by name, in the order calculate_all_metrics returns them
+METRICS = {}
+
+
+def register_metric(name, kernel, agg_exponent, populated=True, symmetric=False, sym_agg_exponent='same'):
+    """Adds a metric to those calculated by calculate_all_metrics and the other entry points.
+
+    Arguments:
+        name: name of the metric in the output
+        kernel: one of the metric functions defined below, or a vectorized function taking the
+            populations of intersections sorted by locality, the locality code of each, and the population
+            of every locality (pops, groups, totals), and returning an array with a score for every locality
+            (localities without intersections may appear in totals; their scores are ignored)
+        agg_exponent: how to aggregate scores across localities, see calculate_metric
+        populated: whether to ignore intersections with zero population
+        symmetric: whether to also calculate the symmetric version, called name + '_sym': the average of
+            the metric and the metric with districts treated as localities
+        sym_agg_exponent: agg_exponent for the metric with districts treated as localities (defaults to
+            agg_exponent)
+
+    Output:
+        MetricDefinition of the metric
+    """
+
+    if sym_agg_exponent == 'same':
+        sym_agg_exponent = agg_exponent
+    definition = MetricDefinition(name, _KERNELS.get(kernel, kernel), agg_exponent, populated, symmetric,
+                                  sym_agg_exponent)
+    METRICS[name] = definition
+    return definition
+
+
+@functools.lru_cache(maxsize=None)
+def diversity_kernel(order, index='hill'):
+    """Returns a vectorized kernel for the diversity index of one order, to pass to register_metric.
+
+    The conditional_entropy, sqrt_entropy and effective_splits metrics are special cases: the Renyi
+    entropy of order 1, the square root of the Hill number of order 1/2, and the Hill number of order 2
+    minus 1. See calculate_diversity_metrics for the indices.
+
+        register_metric('renyi_3', diversity_kernel(3, 'renyi'), 1, symmetric=True)
+    """
+
+    def kernel(pops, groups, totals):
+        return _diversity_indices(_diversity_sums(pops, groups, totals, [order]), [order], index)[0]
+
+    kernel.__name__ = f'_{index}_{order:g}_kernel'
+    return kernel
+
+
+@contextlib.contextmanager
+def profiling(memory=False):
+    """Records how long each phase of the metric calculations takes while the context is active.
+
+    Calls to calculate_all_metrics, calculate_metric and the other entry points made inside the
+    context record the wall time and number of calls of every phase (factorizing, summing
+    intersections, grouping, each metric, aggregating, and for calculate_metric the filtering and
+    groupby, including every call of the metric function). Timing only costs a clock read per phase,
+    so it is cheap enough to leave on.
+
+        with metrics.profiling() as profile:
+            metrics.calculate_all_metrics(df, 'cd_2018', lclty_col='county')
+        profile.report()
+
+    Arguments:
+        memory: whether to also record the peak memory allocated in each phase, using tracemalloc
+            (which slows down allocations considerably)
+
+    Output:
+        MetricsProfile collecting the phases
+    """
+
+    profile = MetricsProfile(memory=memory)
+    started = memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    token = _PROFILE.set(profile)
+    try:
+        yield profile
+    finally:
+        _PROFILE.reset(token)
+        if started:
+            tracemalloc.stop()
+
+
+class MetricsProfile:
+    """Wall time, call counts and (optionally) peak memory of every phase recorded by profiling().
+
+    Phases are named by their nesting, e.g. 'calculate_all_metrics/metric.split_pairs'.
+    """
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.phases = {}
+        self._stack = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Records one call of a phase."""
+
+        path = '/'.join([frame[0] for frame in self._stack] + [name])
+
+        # start tracking the peak memory of this phase, after crediting the peak so far to the parent
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if self._stack:
+                self._stack[-1][1] = max(self._stack[-1][1], peak)
+            tracemalloc.reset_peak()
+        else:
+            current = 0
+        frame = [name, current]
+        self._stack.append(frame)
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self._stack.pop()
+
+            # find the peak memory allocated during the phase, and credit it to the parent as well
+            peak = 0
+            if self.memory:
+                peak = max(frame[1], tracemalloc.get_traced_memory()[1])
+                if self._stack:
+                    self._stack[-1][1] = max(self._stack[-1][1], peak)
+                peak -= current
+
+            record = self.phases.setdefault(path, {'calls': 0, 'seconds': 0.0, 'peak_bytes': 0})
+            record['calls'] += 1
+            record['seconds'] += seconds
+            record['peak_bytes'] = max(record['peak_bytes'], peak)
+
+    def report(self):
+        """Returns a DataFrame with a row for every phase: calls, total and mean seconds, and peak
+        memory allocated in bytes (if recorded)."""
+
+        df = pd.DataFrame.from_dict(self.phases, orient='index', columns=['calls', 'seconds', 'peak_bytes'])
+        df.index.name = 'phase'
+        df['mean_seconds'] = df['seconds'] / df['calls']
+        if not self.memory:
+            df = df.drop(columns='peak_bytes')
+        return df
+
+
+class MetricsCache:
+    """Cache of calculated metrics, keyed by a hash of the intersection table and the metrics asked for.
+
+    Pass it as cache to calculate_all_metrics (or Contingency.metrics) to skip scoring tables that have
+    been scored before. The blocks still get grouped into a table, which is what gets hashed, so the
+    cache saves the cost of the metrics themselves. The least recently used entries get dropped once
+    there are more than max_entries.
+
+        cache = metrics.MetricsCache(path='metrics_cache')
+        metrics.calculate_all_metrics(df, 'cd_2018', lclty_col='county', cache=cache)
+        cache.stats()
+
+    Arguments:
+        max_entries: number of entries kept in memory
+        path: directory to also keep every entry in, as a JSON file, so it persists across sessions
+            (entries on disk are never dropped). Metrics whose kernels have no Python code to identify
+            them by (e.g. builtins) only get cached in memory.
+    """
+
+    def __init__(self, max_entries=1024, path=None):
+        self.max_entries = max_entries
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def metrics(self, table, metrics=None):
+        """Returns the metrics of a Contingency table, scoring it only if it isn't cached."""
+
+        key = self.key(table, metrics)
+
+        # entries in memory are also keyed by the kernels themselves, and only kernels identified by
+        # their code get kept on disk
+        kernels = tuple(definition.kernel for definition in METRICS.values())
+        persist = self.path is not None and all(_code_identity(kernel) is not None for kernel in kernels)
+
+        # look in memory, then on disk
+        d = self._entries.get((key, kernels))
+        if d is None and persist:
+            d = self._read(key)
+        if d is not None:
+            self.hits += 1
+            self._store((key, kernels), d)
+            return dict(d)
+
+        # score the table and remember the scores
+        self.misses += 1
+        d = table.metrics(metrics)
+        self._store((key, kernels), d)
+        if persist:
+            self._write(key, d)
+        return dict(d)
+
+    def key(self, table, metrics=None):
+        """Returns the cache key of a table and the metrics asked for, including how they are defined (with
+        the code of their kernels)."""
+
+        names = _metric_names(metrics)
+        definitions = [(definition.name, _code_identity(definition.kernel), definition.agg_exponent,
+                        definition.populated, definition.symmetric, definition.sym_agg_exponent)
+                       for definition in METRICS.values()]
+        digest = hashlib.blake2b(repr((names, definitions)).encode(), digest_size=8)
+        return table.fingerprint() + '-' + digest.hexdigest()
+
+    def stats(self):
+        """Returns a dictionary with the number of hits, misses and entries in memory, and the hit rate."""
+
+        calls = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries),
+                'hit_rate': self.hits / calls if calls else 0.0}
+
+    def clear(self):
+        """Drops every entry in memory (but not on disk) and resets the counters."""
+
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def _store(self, key, d):
+        # keep the entry as the most recently used one, dropping the least recently used ones
+        self._entries[key] = d
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _read(self, key):
+        try:
+            with open(os.path.join(self.path, key + '.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, key, d):
+        # write to a temporary file first so readers never see a partial entry
+        file = os.path.join(self.path, key + '.json')
+        with open(file + '.tmp', 'w') as f:
+            json.dump({metric: score.item() if hasattr(score, 'item') else score
+                       for metric, score in d.items()}, f)
+        os.replace(file + '.tmp', file)
+
+
+def _code_identity(function):
+    """Returns a hash of the module, name and code of a function and of the functions its closure wraps,
+    or None if it has no Python code to hash (e.g. a builtin)."""
+
+    code = getattr(function, '__code__', None)
+    if code is None:
+        return None
+
+    # hash the bytecode, constants and names used, including those of nested functions
+    parts = [function.__module__, function.__qualname__]
+    codes = [code]
+    while codes:
+        code = codes.pop()
+        parts += [code.co_code, code.co_names]
+        for const in code.co_consts:
+            if isinstance(const, types.CodeType):
+                codes.append(const)
+            else:
+                parts.append(repr(const))
+
+    # identify the functions wrapped by the closure (e.g. the metric function of a wrapped kernel)
+    for cell in function.__closure__ or ():
+        try:
+            value = cell.cell_contents
+        except ValueError:
+            continue
+        if callable(value):
+            value = _code_identity(value)
+            if value is None:
+                return None
+        parts.append(repr(value))
+
+    return hashlib.blake2b(repr(parts).encode(), digest_size=8).hexdigest()
+
+
+def _phase(name):
+    """Returns a context recording a phase in the active profile, if any."""
+
+    profile = _PROFILE.get()
+    if profile is None:
+        return _NO_PHASE
+    return profile.phase(name)
+
+
+def _profiled(metric_function):
+    """Wraps a metric function so each call gets recorded as a phase."""
+
+    @functools.wraps(metric_function)
+    def profiled(pops):
+        with _phase('metric.' + metric_function.__name__):
+            return metric_function(pops)
+
+    return profiled
 
-    # otherwise just add up the scores
-    else:
-        score = lclty_metrics[metric_col].sum()
 
-    return score
+# profile recording phases, set by profiling()
+_PROFILE = contextvars.ContextVar('profile', default=None)
+_NO_PHASE = contextlib.nullcontext()
 
 
 def localities_split(pops):
@@ -203,3 +1497,805 @@ def effective_splits(pops):
 
     # return effective splits
     return 1 / (props ** 2).sum() - 1
+
+
+def _factorize(values):
+    """Encodes a pandas Series (or array, or pyarrow Array or ChunkedArray) as integer codes into its sorted
+    unique values. Missing values get the code -1, matching how pandas groupby drops them.
+
+    Categorical and dictionary-encoded columns reuse their codes, and integers spanning a small range
+    get coded by shifting, so neither gets hashed or converted to objects.
+    """
+
+    # arrow columns use their dictionary indices as codes, getting dictionary encoded first if needed
+    if _is_arrow(values):
+        return _factorize_arrow(values)
+
+    if not hasattr(values, 'dtype'):
+        values = np.asarray(values)
+
+    # categoricals use their codes, renumbered into the categories that appear
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        values = values.array if isinstance(values, pd.Series) else values
+        return _factorize_codes(np.asarray(values.codes), values.categories, values.ordered)
+
+    # integers spanning a small range use their offset from the smallest one
+    kind = values.dtype.kind if isinstance(values.dtype, np.dtype) else None
+    if kind == 'i' or kind == 'u' and values.dtype.itemsize < 8:
+        array = np.asarray(values)
+        if len(array):
+            low = int(array.min())
+            span = int(array.max()) - low + 1
+            if span <= max(2 * len(array), 1 << 20):
+                shifted = array.astype(np.int64) - low
+                present = np.bincount(shifted, minlength=span) > 0
+                labels = (np.flatnonzero(present) + low).astype(array.dtype)
+                codes = (np.cumsum(present) - 1)[shifted]
+                return codes, pd.Index(labels) if isinstance(values, pd.Series) else labels
+
+    codes, labels = pd.factorize(values, sort=True)
+    return codes, labels
+
+
+def _factorize_codes(codes, categories, ordered=False):
+    """Renumbers codes into categories (-1 for missing) into codes into the categories that appear,
+    sorted by value (or kept in the order of the categories if ordered)."""
+
+    # find the categories that appear, in order
+    categories = pd.Index(categories)
+    present = np.bincount(codes[codes >= 0], minlength=len(categories)) > 0
+    order = np.arange(len(categories)) if ordered else categories.argsort()
+    order = order[present[order]]
+
+    # give each one its position, keeping -1 for missing values
+    new_codes = np.full(len(categories) + 1, -1, dtype=np.int64)
+    new_codes[order] = np.arange(len(order))
+    return new_codes[codes], categories[order]
+
+
+def _is_arrow(values):
+    """Whether values is a pyarrow Array or ChunkedArray (without importing pyarrow)."""
+
+    return type(values).__module__.startswith('pyarrow') and hasattr(values, 'type')
+
+
+def _factorize_arrow(values):
+    """Encodes a pyarrow Array or ChunkedArray like _factorize, from its dictionary indices."""
+
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    # integers without missing values are already codes
+    if pa.types.is_integer(values.type) and not values.null_count:
+        return _factorize(_arrow_array(values))
+
+    # give every chunk the same dictionary
+    if not pa.types.is_dictionary(values.type):
+        values = pc.dictionary_encode(values)
+    if isinstance(values, pa.ChunkedArray):
+        values = values.unify_dictionaries()
+        dictionary = values.chunk(0).dictionary if values.num_chunks else pa.array([], values.type.value_type)
+        indices = pa.chunked_array([chunk.indices for chunk in values.chunks], values.type.index_type)
+    else:
+        dictionary, indices = values.dictionary, values.indices
+
+    # use the indices as codes, with -1 for missing values
+    codes = _arrow_array(pc.fill_null(indices, -1) if indices.null_count else indices).astype(np.int64)
+    return _factorize_codes(codes, dictionary.to_pandas(), values.type.ordered)
+
+
+def _arrow_array(values):
+    """Converts a pyarrow Array or ChunkedArray to a numpy array, without copying a single chunk of
+    numbers without missing values."""
+
+    if hasattr(values, 'combine_chunks'):
+        values = values.chunk(0) if values.num_chunks == 1 else values.combine_chunks()
+    return values.to_numpy(zero_copy_only=False)
+
+
+def _column_array(column):
+    """Returns a column of populations (a pandas Series, pyarrow Array or ChunkedArray, or anything
+    array-like) as a numpy array, without copying where possible."""
+
+    if _is_arrow(column):
+        return _arrow_array(column)
+    if isinstance(column, pd.Series):
+        return column.to_numpy()
+    return np.asarray(column)
+
+
+def _read_chunks(path, usecols, pop_col, chunksize):
+    """Yields a block file (CSV, or Parquet which requires pyarrow) as DataFrames of chunksize rows,
+    with every column but population read as strings."""
+
+    # read parquet files a batch of rows at a time
+    if str(path).endswith(('.parquet', '.pq')):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=usecols):
+            chunk = batch.to_pandas()
+            for col in chunk.columns.drop(pop_col):
+                chunk[col] = chunk[col].astype(str).where(chunk[col].notna())
+            yield chunk
+
+    # read csv files a chunk of lines at a time
+    else:
+        dtype = collections.defaultdict(lambda: str, {pop_col: float})
+        yield from pd.read_csv(path, usecols=usecols, dtype=dtype, chunksize=chunksize)
+
+
+def _file_columns(path):
+    """Returns the column names of a block file."""
+
+    if str(path).endswith(('.parquet', '.pq')):
+        import pyarrow.parquet as pq
+        return pq.read_schema(path).names
+    return pd.read_csv(path, nrows=0).columns
+
+
+def _merge_pair_sums(partials):
+    """Adds up partial population sums indexed by (locality, district) pair."""
+
+    return pd.concat(partials).groupby(level=[0, 1], sort=False).sum()
+
+
+def _indptr(rows, n_rows):
+    """Returns CSR row pointers for sorted row codes."""
+
+    return np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=n_rows))])
+
+
+def _label_array(labels):
+    """Converts labels to an array that can be saved without pickling."""
+
+    labels = np.asarray(labels)
+    if labels.dtype.kind == 'O':
+        labels = labels.astype(str)
+    return labels
+
+
+def _district_codes(assignments):
+    """Encodes a 2-D array of district assignments as integer codes ordered like the district labels.
+
+    Output:
+        (codes, n_codes), with code -1 for missing districts
+    """
+
+    # integer districts spanning a small range just get shifted to start at zero
+    if assignments.dtype.kind in 'iub':
+        if assignments.size == 0:
+            return assignments.astype(np.int64), 0
+        low = int(assignments.min())
+        span = int(assignments.max()) - low + 1
+        if span <= max(2 * assignments.size, 1 << 20):
+            return assignments.astype(np.int64) - low, span
+
+    # anything else (including sparse integer labels) gets factorized
+    codes, labels = _factorize(assignments.ravel())
+    return codes.reshape(assignments.shape), len(labels)
+
+
+def _intersection_table(lclty_codes, plan_codes, pops, n_lcltys, n_plans):
+    """Sums populations over every (locality, district) pair of integer-coded blocks.
+
+    Arguments:
+        lclty_codes: integer locality code for every block (-1 for missing)
+        plan_codes: integer district code for every block (-1 for missing)
+        pops: population of every block, or a 2-D array with a column for each of several population weights
+        n_lcltys: number of distinct locality codes
+        n_plans: number of distinct district codes
+
+    Output:
+        (rows, cols, pops) arrays with one entry per (locality, district) pair containing at least one
+        block, sorted by locality and then district. Populations are floats because big ints introduce bugs,
+        with a column for each weight when there are several.
+    """
+
+    # drop blocks with a missing locality or district, as groupby would
+    keep = (lclty_codes >= 0) & (plan_codes >= 0)
+    if not keep.all():
+        lclty_codes, plan_codes, pops = lclty_codes[keep], plan_codes[keep], pops[keep]
+
+    pops = np.asarray(pops)
+
+    # treat a single population as a matrix with one column of weights
+    matrix = pops.ndim == 2
+    n_weights = pops.shape[1] if pops.ndim == 2 else 1
+    pops = pops.reshape(len(pops), n_weights)
+
+    # give every (locality, district) pair a single integer key
+    n_plans = max(n_plans, 1)
+    keys = lclty_codes.astype(np.int64) * n_plans + plan_codes
+    size = n_lcltys * n_plans
+
+    # fractional populations get added up by a pandas groupby, so they round exactly like its compensated
+    # sum (which also skips missing populations)
+    if pops.dtype.kind == 'f' and not _whole(pops):
+        sums = pd.DataFrame(pops).groupby(keys, sort=True).sum()
+        keys, sums = sums.index.to_numpy(), sums.to_numpy()
+
+    # when the table of all pairs is small, add up block populations of every weight in a dense table
+    elif size <= max(2 * len(keys), 1 << 20):
+        counts = np.bincount(keys, minlength=size)
+        weight_keys = keys[:, None] * n_weights + np.arange(n_weights)
+        sums = np.bincount(weight_keys.ravel(), weights=pops.ravel(), minlength=size * n_weights)
+        keys = np.flatnonzero(counts)
+        sums = sums.reshape(size, n_weights)[keys]
+
+    # otherwise sort the blocks by pair and add up each run of equal keys for every weight
+    else:
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        new_pair = np.diff(keys, prepend=-1) != 0
+        n_pairs = new_pair.sum()
+        weight_groups = np.arange(n_weights)[:, None] * n_pairs + (np.cumsum(new_pair) - 1)
+        sums = _group_sum(pops[order].T.ravel(), weight_groups.ravel(), n_weights * n_pairs)
+        sums = sums.reshape(n_weights, n_pairs).T
+        keys = keys[new_pair]
+
+    sums = sums.astype(float)
+    return keys // n_plans, keys % n_plans, sums if matrix else sums[:, 0]
+
+
+def _score_table(rows, cols, pops, n_rows, n_cols, n_batch=None, metrics=None):
+    """Calculates all metrics from a (locality, district) intersection table, see calculate_all_metrics.
+
+    Arguments:
+        rows: locality code of each intersection
+        cols: district code of each intersection
+        pops: population of each intersection
+        n_rows: number of locality codes
+        n_cols: number of district codes
+        n_batch: number of plans stacked in the table, or None for a single plan. Plan i owns the
+            locality codes i * n_rows through (i + 1) * n_rows - 1.
+        metrics: names of the metrics to calculate, see calculate_all_metrics
+
+    Output:
+        dictionary of metric scores, keyed like the output of calculate_all_metrics (with an array of
+        scores, one per plan, for each metric if n_batch is given)
+    """
+
+    n_plans = 1 if n_batch is None else n_batch
+    sides = {}
+
+    def segments(reverse, populated):
+
+        # group the intersections by locality or by district when first needed
+        if (reverse, populated) not in sides:
+            if reverse:
+
+                # give every district its own code within each plan, and stably sort the intersections
+                # by district (the table is sorted by locality, so they stay sorted by locality within)
+                if 'order' not in sides:
+                    sides['cols'] = rows // n_rows * n_cols + cols
+                    sides['order'] = np.argsort(sides['cols'], kind='stable')
+                order = sides['order']
+                sides[reverse, populated] = _Segments(sides['cols'][order], pops[order], n_cols, n_plans,
+                                                      populated=populated)
+            else:
+                sides[reverse, populated] = _Segments(rows, pops, n_rows, n_plans, populated=populated)
+
+        return sides[reverse, populated]
+
+    d = _assemble_metrics(segments, metrics)
+
+    # unwrap the scores of a single plan
+    if n_batch is None:
+        d = {metric: scores[0] for metric, scores in d.items()}
+
+    return d
+
+
+def _assemble_metrics(segments, metrics=None):
+    """Aggregates the registered metrics from grouped intersections.
+
+    Arguments:
+        segments: function taking (reverse, populated) and returning the _Segments of the intersections
+            grouped by locality (or by district if reverse), keeping only the populated ones if populated
+        metrics: names of the metrics to calculate, see calculate_all_metrics
+
+    Output:
+        dictionary with an array of scores, one per plan, for each metric
+    """
+
+    names = _metric_names(metrics)
+    scores = {}
+    reversed_scores = {}
+
+    for definition in METRICS.values():
+        name = definition.name
+        sym_name = name + '_sym'
+        if name not in names and sym_name not in names:
+            continue
+
+        # calculate the metric
+        scores[name] = segments(False, definition.populated).metric(definition.kernel, definition.agg_exponent)
+
+        # calculate the symmetric version, averaging with the metric with districts as localities
+        if sym_name in names:
+            reversed_score = segments(True, definition.populated).metric(definition.kernel,
+                                                                         definition.sym_agg_exponent)
+            reversed_scores[sym_name] = (scores[name] + reversed_score) / 2
+
+    scores.update(reversed_scores)
+    return {name: scores[name] for name in names}
+
+
+def _assemble_sweep(segments, agg_exponents, metrics=None):
+    """Aggregates the registered metrics from grouped intersections with many aggregation exponents,
+    see _assemble_metrics. Both sides of symmetric metrics use the same exponent.
+
+    Output:
+        dictionary with an (exponents x plans) array of scores for each metric
+    """
+
+    names = _metric_names(metrics)
+    scores = {}
+    reversed_scores = {}
+
+    for definition in METRICS.values():
+        name = definition.name
+        sym_name = name + '_sym'
+        if name not in names and sym_name not in names:
+            continue
+
+        # calculate the metric
+        scores[name] = segments(False, definition.populated).sweep(definition.kernel, agg_exponents)
+
+        # calculate the symmetric version, averaging with the metric with districts as localities
+        if sym_name in names:
+            reversed_score = segments(True, definition.populated).sweep(definition.kernel, agg_exponents)
+            reversed_scores[sym_name] = (scores[name] + reversed_score) / 2
+
+    scores.update(reversed_scores)
+    return {name: scores[name] for name in names}
+
+
+class _Segments:
+    """Intersections grouped by locality or district, with the score of every group cached by metric kernel.
+
+    Arguments:
+        groups: sorted group code (locality or district) of each intersection
+        pops: population of each intersection
+        n_groups: number of group codes per plan
+        n_batch: number of plans stacked in the table, plan i owning group codes i * n_groups through
+            (i + 1) * n_groups - 1
+        populated: whether to remove intersections with zero population
+    """
+
+    def __init__(self, groups, pops, n_groups, n_batch=1, populated=True):
+        self.n_batch = n_batch
+        self.populated = populated
+        self.scores = {}
+
+        # if restricting to populated intersections, get rid of the zero-population pairs
+        if populated:
+            keep = pops > 0
+            groups, pops = groups[keep], pops[keep]
+        self.groups, self.pops = groups, pops
+
+        # find the population of every group and which groups have intersections left, and the population
+        # weighting every group, added up like a pandas groupby would
+        self.totals = _group_sum(pops, groups, n_batch * n_groups)
+        self.group_pops = _compensated_group_sum(pops, groups, n_batch * n_groups, self.totals)
+        self.present = np.bincount(groups, minlength=n_batch * n_groups) > 0
+
+    def score(self, kernel):
+        """Returns the score of every group for a vectorized metric kernel taking (pops, groups, totals),
+        with intersections sorted by group, and returning a score per group."""
+
+        if kernel not in self.scores:
+            with _phase('metric.' + _kernel_name(kernel)), np.errstate(divide='ignore', invalid='ignore'):
+                self.scores[kernel] = kernel(self.pops, self.groups, self.totals)
+        return self.scores[kernel]
+
+    def metric(self, kernel, agg_exponent):
+        """Vectorized counterpart of calculate_metric, returning an array of scores, one per plan."""
+
+        # calculate the splitting metric for each group, keeping the groups that have intersections
+        scores = self.score(kernel)[self.present]
+
+        # find the plan each remaining group belongs to
+        owners = np.flatnonzero(self.present) // (len(self.totals) // self.n_batch)
+
+        with _phase('aggregate'):
+            return _aggregate(scores, self.group_pops[self.present], agg_exponent, owners, self.n_batch)
+
+    def explain(self, kernel, agg_exponent):
+        """Returns the parts of metric: the code, population, score and weight of every group with
+        intersections, whose weighted scores add up to the score of their plan."""
+
+        ids = np.flatnonzero(self.present)
+        scores = self.score(kernel)[ids]
+        owners = ids // (len(self.totals) // self.n_batch)
+        weights = _weights(self.group_pops[ids], agg_exponent, owners, self.n_batch)
+        return ids, self.group_pops[ids], scores, weights
+
+    def sweep(self, kernel, agg_exponents):
+        """Like metric, for many aggregation exponents at once, returning an (exponents x plans) array."""
+
+        scores = self.score(kernel)[self.present]
+        owners = np.flatnonzero(self.present) // (len(self.totals) // self.n_batch)
+
+        with _phase('aggregate'):
+            return _aggregate_sweep(scores, self.group_pops[self.present], agg_exponents, owners, self.n_batch)
+
+    def diversity(self, orders, index, agg_exponent):
+        """Like metric, for the diversity index of many orders at once, returning an (orders x plans) array."""
+
+        with _phase('metric.' + index), np.errstate(divide='ignore', invalid='ignore'):
+            sums = _diversity_sums(self.pops, self.groups, self.totals, orders)
+            scores = _diversity_indices(sums, orders, index)[:, self.present]
+
+        # aggregate the scores of every order as segments of (order, plan) pairs
+        owners = np.flatnonzero(self.present) // (len(self.totals) // self.n_batch)
+        order_owners = np.arange(len(orders))[:, None] * self.n_batch + owners
+        with _phase('aggregate'):
+            totals = np.tile(self.group_pops[self.present], len(orders))
+            sums = _aggregate(scores.ravel(), totals, agg_exponent, order_owners.ravel(),
+                              len(orders) * self.n_batch)
+        return sums.reshape(len(orders), self.n_batch)
+
+    def refresh(self, ids, groups, pops):
+        """Recalculates the population, presence and cached scores of some groups.
+
+        Arguments:
+            ids: sorted codes of the groups to recalculate
+            groups: position in ids of each intersection of those groups, sorted
+            pops: population of each intersection of those groups
+        """
+
+        # if restricting to populated intersections, get rid of the zero-population pairs
+        if self.populated:
+            keep = pops > 0
+            groups, pops = groups[keep], pops[keep]
+
+        # recalculate the groups as if they were the only ones
+        totals = _group_sum(pops, groups, len(ids))
+        self.totals[ids] = totals
+        self.group_pops[ids] = _compensated_group_sum(pops, groups, len(ids), totals)
+        self.present[ids] = np.bincount(groups, minlength=len(ids)) > 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for kernel, scores in self.scores.items():
+                scores[ids] = kernel(pops, groups, totals)
+
+
+def _aggregate(scores, lclty_pops, agg_exponent, owners, n_owners):
+    """Aggregates per-locality scores into a single score for each plan, see calculate_metric.
+
+    Arguments:
+        scores: score of each locality
+        lclty_pops: population of each locality
+        agg_exponent: see calculate_metric
+        owners: sorted plan number of each locality
+        n_owners: number of plans
+
+    Output:
+        array of aggregated scores, one per plan
+    """
+
+    # if we are aggregating the scores in some population-weighted way
+    if agg_exponent is not None:
+
+        # prepare the population weights for the scores of each locality
+        weights = _weights(lclty_pops, agg_exponent, owners, n_owners)
+
+        # get a weighted score across all localities
+        return _group_sum(weights * scores, owners, n_owners)
+
+    # otherwise just add up the scores (keeping counts as integers)
+    if scores.dtype.kind in 'iu':
+        return np.bincount(owners, weights=scores, minlength=n_owners).astype(scores.dtype)
+    return _group_sum(scores, owners, n_owners)
+
+
+def _weights(lclty_pops, agg_exponent, owners, n_owners):
+    """Returns the weight of the score of each locality in its plan's score, see calculate_metric
+    (all ones when agg_exponent is None, as the scores are just added up)."""
+
+    if agg_exponent is None:
+        return np.ones(len(lclty_pops))
+
+    weights = lclty_pops / _group_sum(lclty_pops, owners, n_owners)[owners]
+    weights = weights ** agg_exponent
+    return weights / _group_sum(weights, owners, n_owners)[owners]
+
+
+def _aggregate_sweep(scores, lclty_pops, agg_exponents, owners, n_owners):
+    """Aggregates per-locality scores into a score for each plan and each of many aggregation exponents.
+
+    Arguments:
+        scores: score of each locality
+        lclty_pops: population of each locality
+        agg_exponents: list of aggregation exponents, see calculate_metric (None just adds up the scores)
+        owners: sorted plan number of each locality
+        n_owners: number of plans
+
+    Output:
+        (exponents x plans) array of aggregated scores
+    """
+
+    sums = np.empty((len(agg_exponents), n_owners))
+
+    # just add up the scores for every exponent of None
+    summed = np.array([agg_exponent is None for agg_exponent in agg_exponents], dtype=bool)
+    if summed.any():
+        sums[summed] = _aggregate(scores, lclty_pops, None, owners, n_owners)
+
+    # weight the scores for all other exponents at once, with a group for every (exponent, plan) pair
+    exponents = np.array([agg_exponent for agg_exponent in agg_exponents if agg_exponent is not None],
+                         dtype=float)
+    if len(exponents):
+        groups = (np.arange(len(exponents))[:, None] * n_owners + owners).ravel()
+        n_groups = len(exponents) * n_owners
+
+        # prepare the population weights for the scores of each locality
+        weights = lclty_pops / _group_sum(lclty_pops, owners, n_owners)[owners]
+        weights = weights ** exponents[:, None]
+        weights = weights / _group_sum(weights.ravel(), groups, n_groups).reshape(-1, n_owners)[:, owners]
+
+        # get a weighted score across all localities
+        sums[~summed] = _group_sum((weights * scores).ravel(), groups, n_groups).reshape(-1, n_owners)
+
+    return sums
+
+
+def _group_sum(values, groups, n_groups):
+    """Adds up values by sorted group code, rounding exactly like numpy's (and so a pandas Series') sum of
+    each group would. A pandas groupby sum rounds differently, see _compensated_group_sum."""
+
+    values = np.asarray(values, dtype=float)
+
+    # a single group is just a sum
+    if n_groups == 1:
+        return np.array([values.sum()])
+
+    lengths = np.bincount(groups, minlength=n_groups)
+    starts = np.cumsum(lengths) - lengths
+    return _pairwise_sum(values, starts, lengths)
+
+
+def _compensated_group_sum(values, groups, n_groups, sums):
+    """Adds up values by sorted group code like a pandas groupby sum, which uses compensated (Kahan)
+    summation. Whole numbers add up exactly either way, so for them this is a copy of sums, their
+    _group_sum."""
+
+    if _whole(values):
+        return sums.copy()
+
+    group_sums = pd.Series(values, dtype=float).groupby(groups, sort=True).sum()
+    compensated = np.zeros(n_groups)
+    compensated[group_sums.index.to_numpy()] = group_sums.to_numpy()
+    return compensated
+
+
+def _whole(values):
+    """Returns whether every value is a whole number (so sums of them are exact)."""
+
+    values = np.asarray(values)
+    return values.dtype.kind != 'f' or bool(np.all(np.trunc(values) == values))
+
+
+def _pairwise_sum(values, starts, lengths):
+    """Sums every contiguous segment values[start:start + length] at once, following the pairwise
+    summation numpy uses for a single array: segments of more than 128 values are split in two
+    (at a multiple of 8) and the halves are summed recursively."""
+
+    sums = np.empty(len(starts))
+
+    # short segments get summed directly
+    small = lengths <= 128
+    sums[small] = _blocked_sum(values, starts[small], lengths[small])
+
+    # long segments get split in two
+    big = ~small
+    if big.any():
+        halves = lengths[big] // 2
+        halves -= halves % 8
+        left = _pairwise_sum(values, starts[big], halves)
+        right = _pairwise_sum(values, starts[big] + halves, lengths[big] - halves)
+        sums[big] = left + right
+
+    return sums
+
+
+def _blocked_sum(values, starts, lengths):
+    """Sums segments of at most 128 values the way numpy's pairwise summation does at its base case:
+    8 running partial sums combined in a fixed tree, then the leftover values added in order
+    (segments of fewer than 8 values are just added in order)."""
+
+    sums = np.zeros(len(starts))
+    lanes = np.arange(8)
+
+    # accumulate the 8 partial sums over whole blocks of 8 values
+    blocked = lengths >= 8
+    block_starts = starts[blocked]
+    block_ends = lengths[blocked] - lengths[blocked] % 8
+    if len(block_starts):
+        partial = values[block_starts[:, None] + lanes]
+        for offset in range(8, block_ends.max(), 8):
+            more = block_ends > offset
+            partial[more] += values[block_starts[more, None] + offset + lanes]
+        sums[blocked] = (((partial[:, 0] + partial[:, 1]) + (partial[:, 2] + partial[:, 3]))
+                         + ((partial[:, 4] + partial[:, 5]) + (partial[:, 6] + partial[:, 7])))
+
+    # add the values left over in order
+    rest_starts = starts.copy()
+    rest_starts[blocked] += block_ends
+    rest_lengths = np.where(blocked, lengths % 8, lengths)
+    for i in range(7):
+        more = rest_lengths > i
+        sums[more] += values[rest_starts[more] + i]
+
+    return sums
+
+
+def _localities_split_kernel(pops, groups, totals):
+    """Vectorized localities_split over every group of intersections."""
+
+    return (np.bincount(groups, minlength=len(totals)) > 1).astype(int)
+
+
+def _locality_intersections_kernel(pops, groups, totals):
+    """Vectorized locality_intersections over every group of intersections."""
+
+    return np.bincount(groups, minlength=len(totals))
+
+
+def _split_pairs_kernel(pops, groups, totals):
+    """Vectorized split_pairs over every group of intersections."""
+
+    # find total number of pairs of voters
+    all_pairs = totals * (totals - 1) / 2
+
+    # find number of pairs of voters in same district
+    preserved_pairs = _group_sum(pops * (pops - 1), groups, len(totals)) / 2
+
+    # if there are no pairs of people, return 1 (rare, un-impactful corner case)
+    all_pairs[all_pairs == 0] = 1
+
+    # return proportion of split pairs
+    return (all_pairs - preserved_pairs) / all_pairs
+
+
+def _conditional_entropy_kernel(pops, groups, totals):
+    """Vectorized conditional_entropy over every group of intersections (Renyi entropy of order 1)."""
+
+    return _diversity_sums(pops, groups, totals, [1])[0]
+
+
+def _sqrt_entropy_kernel(pops, groups, totals):
+    """Vectorized sqrt_entropy over every group of intersections (sum of square roots of proportions)."""
+
+    return _diversity_sums(pops, groups, totals, [0.5])[0]
+
+
+def _effective_splits_kernel(pops, groups, totals):
+    """Vectorized effective_splits over every group of intersections (Hill number of order 2, minus 1)."""
+
+    return 1 / _diversity_sums(pops, groups, totals, [2])[0] - 1
+
+
+def _diversity_sums(pops, groups, totals, orders):
+    """Calculates the sum of proportion ^ order over the intersections of every group, for many orders at
+    once. Order 1 gives the entropy in bits instead (the limit of the Renyi entropy). Orders 1, 1/2 and 2
+    are calculated exactly as conditional_entropy, sqrt_entropy and effective_splits do.
+
+    Output:
+        (orders x groups) array of sums
+    """
+
+    # find the share of every intersection in the sum of each order
+    terms = []
+    per_person = []
+    for order in orders:
+
+        # proportions squared, as for effective splits
+        if order == 2:
+            terms.append((pops / totals[groups]) ** 2)
+            per_person.append(False)
+
+        # entropy of every person in each populated intersection, as for conditional entropy
+        elif order == 1:
+            terms.append(np.where(pops > 0, pops * np.log2(totals[groups] / pops), 0))
+            per_person.append(True)
+
+        # proportion ^ order as population times (1 / proportion) ^ (1 - order), as for sqrt entropy
+        elif order == 0.5:
+            terms.append(np.where(pops > 0, pops * np.sqrt(totals[groups] / pops), 0))
+            per_person.append(True)
+        else:
+            terms.append(np.where(pops > 0, pops * (totals[groups] / pops) ** (1 - order), 0))
+            per_person.append(True)
+
+    # add up every (order, group) pair in a single segmented sum
+    n_groups = len(totals)
+    order_groups = np.arange(len(orders))[:, None] * n_groups + groups
+    sums = _group_sum(np.concatenate(terms) if terms else terms, order_groups.ravel(), len(orders) * n_groups)
+    sums = sums.reshape(len(orders), n_groups)
+
+    # turn sums over people into sums per person
+    per_person = np.array(per_person, dtype=bool)
+    sums[per_person] = sums[per_person] / totals
+    return sums
+
+
+def _diversity_indices(sums, orders, index):
+    """Turns the output of _diversity_sums into a diversity index of every order.
+
+        hill: effective number of districts, (sum of proportion ^ q) ^ (1 / (1 - q))
+        renyi: log2 of the Hill number, in bits
+        tsallis: (1 - sum of proportion ^ q) / (q - 1), in nats for order 1
+    """
+
+    indices = np.empty_like(sums)
+    for i, order in enumerate(orders):
+        if index == 'hill':
+            indices[i] = 2 ** sums[i] if order == 1 else sums[i] ** (1 / (1 - order))
+        elif index == 'renyi':
+            indices[i] = sums[i] if order == 1 else np.log2(sums[i]) / (1 - order)
+        elif index == 'tsallis':
+            indices[i] = sums[i] * np.log(2) if order == 1 else (1 - sums[i]) / (order - 1)
+        else:
+            raise ValueError(f"Unknown diversity index: {index!r}, expected 'hill', 'renyi' or 'tsallis'")
+    return indices
+
+
+# vectorized kernels for the metric functions above
+_KERNELS = {
+    localities_split: _localities_split_kernel,
+    locality_intersections: _locality_intersections_kernel,
+    split_pairs: _split_pairs_kernel,
+    conditional_entropy: _conditional_entropy_kernel,
+    sqrt_entropy: _sqrt_entropy_kernel,
+    effective_splits: _effective_splits_kernel,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _kernel(metric_function):
+    """Returns the vectorized kernel for a metric function. Functions without one are wrapped to get
+    called once per group."""
+
+    if metric_function in _KERNELS:
+        return _KERNELS[metric_function]
+
+    def kernel(pops, groups, totals):
+        starts = np.cumsum(np.bincount(groups, minlength=len(totals)))
+        return np.array([metric_function(part) if len(part) else np.nan
+                         for part in np.split(pops, starts[:-1])], dtype=float)
+
+    kernel.__name__ = f'_{metric_function.__name__}_kernel'
+    return kernel
+
+
+def _kernel_name(kernel):
+    """Returns the name of the metric a kernel calculates."""
+
+    name = getattr(kernel, '__name__', repr(kernel))
+    return name.removeprefix('_').removesuffix('_kernel')
+
+
+def _metric_names(metrics=None):
+    """Returns the output names of the metrics to calculate, all registered ones by default."""
+
+    names = [definition.name for definition in METRICS.values()]
+    names += [definition.name + '_sym' for definition in METRICS.values() if definition.symmetric]
+    if metrics is None:
+        return names
+
+    # keep the requested metrics in the order they would otherwise be returned
+    unknown = set(metrics) - set(names)
+    if unknown:
+        raise ValueError(f"Unknown metrics: {sorted(unknown)}")
+    return [name for name in names if name in metrics]
+
+
+# register the built-in metrics
+register_metric('splits_all', localities_split, None, populated=False)
+register_metric('splits_pop', localities_split, None, symmetric=True)
+register_metric('intersections_all', locality_intersections, None, populated=False)
+register_metric('intersections_pop', locality_intersections, None, symmetric=True)
+register_metric('effective_splits', effective_splits, None, symmetric=True, sym_agg_exponent=1)
+register_metric('conditional_entropy', conditional_entropy, 1, symmetric=True)
+register_metric('sqrt_entropy', sqrt_entropy, 1, symmetric=True)
+register_metric('split_pairs', split_pairs, 1, symmetric=True)